@@ -0,0 +1,282 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Repository root, for the shared package
+from shared.edgefilter import EdgeFilter
+from vision import MotionDetector, FaceIndex, MOTION_MODELS, face_recognition
+from tracking import MotionTracker
+
+# Headless replay benchmark for the vision pipeline.
+#   python benchmark.py --video IMG_0699.mov --players 4
+#   python benchmark.py --synthetic --json > baseline.json
+#   python benchmark.py --synthetic --baseline baseline.json
+#   python benchmark.py --synthetic --flicker 12 --compare-models
+#   python benchmark.py --video IMG_0699.mov --truth 1:120,3:240 --compare-models --model-scale 0.5
+
+def synthetic_truth(num_players):
+    # Frame at which each player starts moving in synthetic_clip
+    return {player: 10 * player for player in range(1, num_players + 1)}
+
+def synthetic_clip(num_frames, num_players, width=960, height=540, seed=0, speed=4, flicker=0):
+    """Yield frames of a static noisy scene where player N starts moving at frame 10 * N.
+    flicker adds a random global brightness change of up to that many levels per frame, like mains-powered lighting"""
+    rng = np.random.default_rng(seed)
+    background = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    background = cv2.GaussianBlur(background, (21, 21), 0)
+    lane_width = width // num_players
+
+    for index in range(num_frames):
+        frame = background.copy()
+        for player in range(num_players):
+            x = player * lane_width + lane_width // 4
+            # Every player is drawn, only players whose start frame has passed move
+            offset = int(max(0, index - 10 * (player + 1)) * speed)
+            y = 100 + offset % (height - 300)
+            cv2.rectangle(frame, (x, y), (x + lane_width // 2, y + 200), (200, 200, 200), -1)
+        if flicker:
+            level = int(rng.integers(-flicker, flicker + 1))
+            frame = cv2.add(frame, (level, level, level, 0))
+        yield frame
+
+def video_clip(path, max_frames):
+    video = cv2.VideoCapture(path)
+    if not video.isOpened():
+        raise SystemExit(f"Failed to open video: {path}")
+
+    count = 0
+    while max_frames is None or count < max_frames:
+        ret, frame = video.read()
+        if not ret:
+            break
+        yield cv2.resize(frame, (960, 540))
+        count += 1
+    video.release()
+
+def load_face_index(faces_dir):
+    # Headshots are numbered in file name order, like player IDs
+    if not faces_dir or face_recognition is None:
+        return None
+
+    file_names = sorted(os.listdir(faces_dir))
+    face_index = FaceIndex()
+    face_index.build({player_id: cv2.imread(os.path.join(faces_dir, file_name)) for player_id, file_name in enumerate(file_names, start=1)})
+    return face_index
+
+def percentiles(samples):
+    if not samples:
+        return None
+    values = np.array(samples) * 1000  # milliseconds
+    return {
+        "count": len(samples),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+    }
+
+def parse_truth(text):
+    # "1:120,3:240" -> player 1 starts moving at frame 120, player 3 at frame 240
+    if not text:
+        return None
+    return {int(player): int(frame) for player, frame in (item.split(":") for item in text.split(","))}
+
+def run(frames, num_players, bodies_every, face_index, motion_model="reference", model_scale=1.0, truth=None, persist=None, edge_filter=None):
+    """Replay frames and time every stage. With truth ({player: frame the player starts moving}), motion reported
+    in a lane before that frame counts as a false positive; players missing from truth are not scored.
+    persist is (frames, window) for the MotionTracker stage, eliminations are then only counted once confirmed.
+    Frames an edge_filter holds back never reach the detector, as on the doll, but keep their index, which stands in
+    for the capture sequence number"""
+    motion_detector = MotionDetector(motion_model=motion_model, model_scale=model_scale)
+    motion_detector.set_regions(num_players)
+    motion_tracker = MotionTracker(num_players, *persist) if persist else None
+    timings = {stage: [] for stage in ("decode", "preprocess", "detect_players", "track", "contours_get_label", "identify_motion", "detect_bodies", "match_faces")}
+    eliminations = {}
+    false_positives = 0
+    still_lane_frames = 0
+    num_frames = 0
+
+    start = time.perf_counter()
+    for index, frame in enumerate(frames):
+        if edge_filter is not None and not edge_filter.passes(frame, index):
+            continue
+
+        # Frames reach the backend as JPEG, so decoding is part of the measured path
+        _, buffer = cv2.imencode(".jpg", frame)
+
+        t0 = time.perf_counter()
+        frame = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+        t1 = time.perf_counter()
+        gray = motion_detector.preprocess(frame)
+        t2 = time.perf_counter()
+        detections = motion_detector.detect_players(gray, index)
+        t3 = time.perf_counter()
+        timings["decode"].append(t1 - t0)
+        timings["preprocess"].append(t2 - t1)
+        timings["detect_players"].append(t3 - t2)
+
+        if motion_tracker is not None:
+            t0 = time.perf_counter()
+            detections = motion_tracker.update(range(1, num_players + 1), detections, motion_detector.lane_centroids(detections), index)
+            timings["track"].append(time.perf_counter() - t0)
+
+        # The contour path is only used for debug overlays now, timed on the same mask
+        if index > 0:
+            t0 = time.perf_counter()
+            contours, _ = cv2.findContours(motion_detector.mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            for contour in contours:
+                if cv2.contourArea(contour) > motion_detector.min_area:
+                    motion_detector.get_label(contour)
+            timings["contours_get_label"].append(time.perf_counter() - t0)
+
+        # Motion-gated identification, skipped on still frames
+        if detections:
+            t0 = time.perf_counter()
+            motion_detector.identify_motion(frame, detections, face_index)
+            timings["identify_motion"].append(time.perf_counter() - t0)
+
+        for player_id, score in detections:
+            if player_id not in eliminations:
+                eliminations[player_id] = {"frame": index, "score": score}
+            if truth and player_id in truth and index < truth[player_id]:
+                false_positives += 1
+        if truth and index > 0:
+            still_lane_frames += sum(1 for start in truth.values() if index < start)
+
+        if bodies_every and index % bodies_every == 0:
+            t0 = time.perf_counter()
+            bodies = motion_detector.detect_bodies(frame)
+            timings["detect_bodies"].append(time.perf_counter() - t0)
+
+            if face_index:
+                t0 = time.perf_counter()
+                motion_detector.match_faces(frame, bodies, face_index)
+                timings["match_faces"].append(time.perf_counter() - t0)
+
+        num_frames += 1
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "motion_model": motion_model,
+        "model_scale": model_scale,
+        "persist": list(persist) if persist else None,
+        "frames": num_frames,
+        # Includes the untimed JPEG encode used to simulate the wire format
+        "fps": num_frames / elapsed if elapsed else 0.0,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": {stage: percentiles(samples) for stage, samples in timings.items() if samples},
+        "eliminations": {str(player_id): decision for player_id, decision in sorted(eliminations.items())},
+    }
+    if edge_filter is not None:
+        report["frames_filtered"] = edge_filter.filtered
+    if truth:
+        report["false_positives"] = {
+            "lane_frames": false_positives,
+            "rate": false_positives / still_lane_frames if still_lane_frames else 0.0,
+        }
+    return report
+
+def print_report(report, baseline=None):
+    print(f"Motion model: {report['motion_model']} at scale {report['model_scale']}")
+    print(f"Frames: {report['frames']}  FPS: {report['fps']:.1f}  Peak RSS: {report['peak_rss_mb']:.1f} MB")
+    if "false_positives" in report:
+        print(f"False positives: {report['false_positives']['lane_frames']} still lane frames ({report['false_positives']['rate'] * 100:.1f}%)")
+    print(f"{'stage':<20}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'vs base p50':>14}")
+    for stage, stats in report["stages"].items():
+        delta = ""
+        if baseline and stage in baseline.get("stages", {}):
+            base_p50 = baseline["stages"][stage]["p50_ms"]
+            delta = f"{(stats['p50_ms'] - base_p50) / base_p50 * 100:+.1f}%" if base_p50 else ""
+        print(f"{stage:<20}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}{delta:>14}")
+
+    print("Eliminations:")
+    for player_id, decision in report["eliminations"].items():
+        line = f"  Player {player_id} at frame {decision['frame']} (score {decision['score']})"
+        if baseline:
+            base_decision = baseline.get("eliminations", {}).get(player_id)
+            if base_decision is None or base_decision["frame"] != decision["frame"]:
+                line += f"  [baseline: {base_decision['frame'] if base_decision else 'not eliminated'}]"
+        print(line)
+    if baseline:
+        for player_id in baseline.get("eliminations", {}):
+            if player_id not in report["eliminations"]:
+                print(f"  Player {player_id} not eliminated  [baseline: frame {baseline['eliminations'][player_id]['frame']}]")
+
+def print_comparison(reports):
+    print(f"{'model':<12}{'scale':>6}{'p50 ms':>10}{'p95 ms':>10}{'FPS':>8}{'FP rate':>10}  first detection per player")
+    for report in reports:
+        stats = report["stages"]["detect_players"]
+        false_positives = report.get("false_positives")
+        rate = f"{false_positives['rate'] * 100:.1f}%" if false_positives else "n/a"
+        first = ", ".join(f"{player_id}@{decision['frame']}" for player_id, decision in report["eliminations"].items())
+        print(f"{report['motion_model']:<12}{report['model_scale']:>6}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{report['fps']:>8.1f}{rate:>10}  {first}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay footage through the vision pipeline and report per-stage latency")
+    parser.add_argument("--video", default="IMG_0699.mov", help="Recorded clip to replay")
+    parser.add_argument("--synthetic", action="store_true", help="Use a generated clip instead of --video")
+    parser.add_argument("--frames", type=int, default=300, help="Maximum number of frames to replay")
+    parser.add_argument("--players", type=int, default=4, help="Number of player lanes")
+    parser.add_argument("--bodies-every", type=int, default=10, help="Run detect_bodies every N frames, 0 to disable")
+    parser.add_argument("--faces", help="Directory of known player headshots for match_faces")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--baseline", help="JSON report from a previous run to compare against")
+    parser.add_argument("--motion-model", choices=MOTION_MODELS, default="reference", help="Motion model to replay with")
+    parser.add_argument("--model-scale", type=float, default=1.0, help="Internal resolution of the background models")
+    parser.add_argument("--compare-models", action="store_true", help="Replay the clip through every motion model, motion detection only")
+    parser.add_argument("--truth", help="Frame each player starts moving, e.g. 1:120,3:240, to score false positives on --video")
+    parser.add_argument("--persist", type=int, default=0, help="Frames of persistent motion before an elimination, 0 to skip the tracker")
+    parser.add_argument("--window", type=int, default=5, help="Sliding window for --persist, in frames")
+    parser.add_argument("--speed", type=float, default=4, help="Synthetic player speed in pixels per frame")
+    parser.add_argument("--flicker", type=int, default=0, help="Synthetic global brightness flicker in grey levels")
+    parser.add_argument("--edge-filter", action="store_true", help="Replay with and without the doll's edge motion filter and compare eliminations")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        frames = synthetic_clip(args.frames, args.players, speed=args.speed, flicker=args.flicker)
+        truth = synthetic_truth(args.players)
+    else:
+        frames = video_clip(args.video, args.frames)
+        truth = parse_truth(args.truth)
+    persist = (args.persist, args.window) if args.persist else None
+
+    if args.compare_models:
+        # Every model sees the same decoded clip, identification is left out so only motion detection differs
+        frames = list(frames)
+        reports = [run(frames, args.players, 0, None, model, 1.0 if model == "reference" else args.model_scale, truth, persist) for model in MOTION_MODELS]
+        if args.json:
+            print(json.dumps(reports, indent=2))
+        else:
+            print_comparison(reports)
+        raise SystemExit
+
+    if args.edge_filter:
+        # Same clip twice, the unfiltered replay is the baseline the filtered eliminations must match frame for frame
+        frames = list(frames)
+        unfiltered = run(frames, args.players, 0, None, args.motion_model, args.model_scale, truth, persist)
+        filtered = run(frames, args.players, 0, None, args.motion_model, args.model_scale, truth, persist, EdgeFilter())
+        match = {player_id: decision["frame"] for player_id, decision in unfiltered["eliminations"].items()} == \
+                {player_id: decision["frame"] for player_id, decision in filtered["eliminations"].items()}
+        if args.json:
+            print(json.dumps({"unfiltered": unfiltered, "edge_filter": filtered, "eliminations_match": match}, indent=2))
+        else:
+            print_report(filtered, unfiltered)
+            print(f"Edge filter held back {filtered['frames_filtered']} of {len(frames)} frames, "
+                  f"eliminations {'match' if match else 'DIFFER from'} the unfiltered replay")
+        raise SystemExit(0 if match else 1)
+
+    report = run(frames, args.players, args.bodies_every, load_face_index(args.faces), args.motion_model, args.model_scale, truth, persist)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        print_report(report, baseline)
@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+import cv2
+import numpy as np
+import websockets
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Repository root, for the shared package
+from benchmark import synthetic_clip, percentiles
+from shared.framering import FrameRing
+from shared.protocol import pack_frame, unpack_frame
+from vision import MotionDetector
+
+# Frame transport latency between two processes on one host, from the doll holding a captured frame
+# to the backend holding it preprocessed: JPEG over a localhost WebSocket versus raw frames in shared memory.
+#   python benchmark_transport.py --frames 300 --fps 30
+# Both processes stamp frames with time.monotonic(), which is one system-wide clock on Linux.
+
+RING_NAME = "squid-frames-benchmark"
+
+def clip(num_frames, unique_frames=30):
+    # A short clip played in a loop, so memory use doesn't grow with --frames
+    frames = list(synthetic_clip(unique_frames, 4))
+    return [frames[index % unique_frames] for index in range(num_frames)]
+
+def websocket_producer(port, num_frames, fps, quality):
+    async def produce():
+        frames = clip(num_frames)
+        async with websockets.connect(f"ws://127.0.0.1:{port}", max_size=None) as ws:
+            for seq, frame in enumerate(frames):
+                start = time.monotonic()
+                _, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+                await ws.send(pack_frame(seq, start, frame.shape[1], frame.shape[0], buffer))
+                await asyncio.sleep(max(0.0, 1 / fps - (time.monotonic() - start)))
+    asyncio.run(produce())
+
+def ring_producer(num_frames, fps):
+    frames = clip(num_frames)
+    ring = FrameRing(RING_NAME)
+    for seq, frame in enumerate(frames):
+        start = time.monotonic()
+        ring.write(seq, start, frame)
+        time.sleep(max(0.0, 1 / fps - (time.monotonic() - start)))
+    ring.close()
+
+async def run_websocket(num_frames, fps, quality, port):
+    motion_detector = MotionDetector()
+    latencies = []
+    done = asyncio.Event()
+
+    async def consume(ws):
+        async for message in ws:
+            header, payload = unpack_frame(message)
+            frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+            motion_detector.preprocess(frame)
+            latencies.append(time.monotonic() - header.timestamp)
+        done.set()
+
+    async with websockets.serve(consume, "127.0.0.1", port, max_size=None):
+        producer = multiprocessing.Process(target=websocket_producer, args=(port, num_frames, fps, quality))
+        producer.start()
+        await done.wait()
+        producer.join()
+    return {"transport": "websocket_jpeg", "latency": percentiles(latencies), "frames": len(latencies)}
+
+def run_ring(num_frames, fps, poll_interval):
+    motion_detector = MotionDetector()
+    ring = FrameRing(RING_NAME, create=True)
+    latencies = []
+    torn = 0
+    producer = multiprocessing.Process(target=ring_producer, args=(num_frames, fps))
+    producer.start()
+    while True:
+        # Checked before reading, so every frame written before the producer exited is still read
+        finished = not producer.is_alive()
+        entry = ring.read()
+        if entry is None:
+            if finished:
+                break
+            time.sleep(poll_interval)
+            continue
+        index, header, pixels = entry
+        motion_detector.preprocess(pixels)
+        if ring.is_intact(index):
+            latencies.append(time.monotonic() - header.timestamp)
+        else:
+            torn += 1
+    producer.join()
+    report = {"transport": "shared_memory", "latency": percentiles(latencies), "frames": len(latencies),
+              "lapped": ring.frames_lapped, "torn": torn}
+    ring.close()
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare frame latency over a localhost WebSocket and a shared memory ring")
+    parser.add_argument("--frames", type=int, default=300, help="Frames to send over each transport")
+    parser.add_argument("--fps", type=float, default=30, help="Frame rate of the producer")
+    parser.add_argument("--quality", type=int, default=95, help="JPEG quality for the WebSocket transport")
+    parser.add_argument("--port", type=int, default=8799, help="Local port for the WebSocket transport")
+    parser.add_argument("--poll-interval", type=float, default=0.002, help="Seconds between shared memory ring polls")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    reports = [asyncio.run(run_websocket(args.frames, args.fps, args.quality, args.port)),
+               run_ring(args.frames, args.fps, args.poll_interval)]
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print(f"{'transport':<18}{'frames':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for report in reports:
+            latency = report["latency"]
+            print(f"{report['transport']:<18}{report['frames']:>8}{latency['p50_ms']:>10.2f}{latency['p95_ms']:>10.2f}{latency['p99_ms']:>10.2f}")
@@ -1,13 +1,23 @@
 import asyncio
 import websockets
-import cv2
-import numpy as np
 import json
 import time
 import os
 import logging
-from vision import MotionDetector
-import base64
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Repository root, for the shared package
+from vision import MotionDetector, FaceIndex
+from shared.protocol import unpack_frame
+from shared.framering import FrameRing
+from shared.lanes import Lane, lanes_by_camera
+from workers import CameraWorkers
+from pipeline import FramePipeline
+from tracking import MotionTracker
+from preview import PreviewSink
+from shared.players import PlayerRegistry
+from shared.tracing import Tracer
+from shared.metrics import Counter, Gauge, Histogram, LATENCY_BUCKETS, serve_metrics, monitor_event_loop_lag
+import functools
 import dotenv
 dotenv.load_dotenv()
 
@@ -22,90 +32,333 @@ EVIN_IP = os.environ['EVIN_IP']
 CURRENT_IP = RPI_IP
 BACKEND_PORT = os.environ['BACKEND_PORT']
 CURRENT_SERVER_URL = f"ws://{CURRENT_IP}:{BACKEND_PORT}"
-MAX_NUM_PLAYERS = 4
+MAX_NUM_PLAYERS = int(os.environ.get('MAX_NUM_PLAYERS', '32'))  # Highest player ID, sizes the per-lane tracking state
+CAMERA_WORKERS = int(os.environ.get('CAMERA_WORKERS', '0'))  # Worker processes for multi-camera lane layouts, one per camera
+ACK_INTERVAL = 5  # Acknowledge every Nth processed frame so the doll can measure processing lag
+RING_POLL_INTERVAL = 0.002  # Seconds between checks for new frames in the shared memory ring
+STREAM_ELIMINATIONS = os.environ.get('STREAM_ELIMINATIONS', '1') == '1'  # Push each elimination as soon as it is detected
+TRACE_FILE = os.environ.get('TRACE_FILE')  # JSONL file for latency trace spans, tracing is off when unset
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '8768'))
+MOTION_MODEL = os.environ.get('MOTION_MODEL', 'reference')  # reference, average or mog2, see vision.MOTION_MODELS
+MOTION_MODEL_SCALE = float(os.environ.get('MOTION_MODEL_SCALE', '1.0'))  # Internal resolution of the background models
+PERSIST_FRAMES = int(os.environ.get('PERSIST_FRAMES', '3'))  # Frames of motion on one track before a player is eliminated,
+PERSIST_WINDOW = int(os.environ.get('PERSIST_WINDOW', '5'))  # out of the last PERSIST_WINDOW frames of their lane
+SHOW_WINDOW = os.environ.get('SHOW_WINDOW', '0') == '1'  # Local OpenCV preview window, off on headless servers
+PREVIEW_PORT = os.environ.get('PREVIEW_PORT')  # MJPEG preview stream of annotated frames, off when unset
+PREVIEW_HOST = os.environ.get('PREVIEW_HOST', '127.0.0.1')
+PREVIEW_FPS = float(os.environ.get('PREVIEW_FPS', '5'))
+PLAYER_IMAGES_DIR = os.environ.get('PLAYER_IMAGES_DIR')  # Also save registration photos here, they are only kept in memory when unset
 
 # Global variables
 game_in_progress = False
-players_info = [None] * 5
+player_registry = PlayerRegistry(persist_dir=PLAYER_IMAGES_DIR)  # Registration photos by player ID
+player_registration = None  # Task loading the current players and building their face index
+player_thumbnails = {}  # Player ID -> base64 thumbnail, received one per message ahead of players_info
 num_players = 0
 all_eliminated_players = set() # A list to track eliminated players
 is_streaming = False # Flag to track if video frames are currently being processed
+frames_processed = 0  # Frames processed in the current window, for acknowledgements
+current_round = None  # Round ID sent by the doll with start_video_stream, used to join trace files
 
 # Initialize motion detector and player identifier
-motion_detector = MotionDetector()
+def new_motion_detector():
+    return MotionDetector(motion_model=MOTION_MODEL, model_scale=MOTION_MODEL_SCALE)
+
+motion_detector = new_motion_detector()
+motion_tracker = MotionTracker(MAX_NUM_PLAYERS, PERSIST_FRAMES, PERSIST_WINDOW)  # Filters single-frame noise before eliminations
+lane_detectors = {}  # One MotionDetector per player lane, used when the doll sends lane crops
+face_index = FaceIndex()  # Player face embeddings, rebuilt in the background when players register
+frame_pipeline = None  # Created inside the event loop by main()
+warm_up_future = None  # Model warm-up, finished before the first video stream starts
+tracer = Tracer(TRACE_FILE, "backend")
+frame_ring = None  # Shared memory ring of raw frames, attached when the doll streams through one
+camera_workers = None  # Created by main() when CAMERA_WORKERS is set
+use_camera_workers = False  # The current stream has a lane layout, so frames go to the camera workers
+preview = PreviewSink(max_fps=PREVIEW_FPS, show_window=SHOW_WINDOW)
+
+# Metrics, served on METRICS_PORT. Decode and detect timings are recorded by the frame pipeline
+FRAMES_RECEIVED = Counter("squid_frames_received_total", "Video frames received from the doll")
+BYTES_RECEIVED = Counter("squid_frame_bytes_received_total", "Video frame message bytes received from the doll")
+FRAMES_IN_FLIGHT = Gauge("squid_pipeline_frames_in_flight", "Frames queued or being processed by the frame pipeline",
+                         function=lambda: len(frame_pipeline.in_flight) if frame_pipeline else 0)
+FRAME_JITTER_SECONDS = Histogram("squid_frame_jitter_seconds", "Change in arrival interval between consecutive frames", LATENCY_BUCKETS)
+FRAMES_LAPPED = Counter("squid_ring_frames_lapped_total", "Shared memory frames overwritten by the doll before they were read",
+                        function=lambda: frame_ring.frames_lapped if frame_ring else 0)
+ELIMINATIONS_PER_ROUND = Histogram("squid_eliminations_per_round", "Players eliminated per video stream window", range(MAX_NUM_PLAYERS + 1))
+EVENT_LOOP_LAG_SECONDS = Histogram("squid_event_loop_lag_seconds", "Delay of the event loop in waking a sleeping task", LATENCY_BUCKETS)
 
 async def send_eliminated_players(ws, eliminated_players):
     # There is already a check making sure newly eliminated players have not been eliminated before
     if eliminated_players is not None:
-        await ws.send(json.dumps({"type": "eliminated_players", "data": list(eliminated_players)}))
+        await ws.send(json.dumps({"type": "eliminated_players", "data": list(eliminated_players), "round": current_round}))
         logging.info(f"Sent eliminated players: {eliminated_players}")
 
     # Update the list of all eliminated players
     all_eliminated_players.update(eliminated_players)
 
+def build_face_index(player_images):
+    try:
+        num_indexed = face_index.build(player_images)
+        logging.info(f"Built face index for {num_indexed} of {len(player_images)} players")
+    except Exception as e:
+        logging.error(f"Error building face index: {e}")
+
+async def register_players(player_images, num_players):
+    # player_images is {player_id: base64 image}, players that registered without a photo are missing from it
+    try:
+        loaded = await player_registry.register({player_id: image for player_id, image in player_images.items() if image})
+        logging.info(f"Loaded images for {loaded} of {num_players} players")
+        # Compute the face embeddings off the event loop, matching only needs the finished index
+        await asyncio.get_running_loop().run_in_executor(None, build_face_index, player_registry.images)
+    except Exception as e:
+        logging.error(f"Error registering players: {e}")
+
+async def send_player_eliminated(ws, player_id, header):
+    # Incremental elimination, tagged with the frame that triggered it
+    await ws.send(json.dumps({
+        "type": "player_eliminated",
+        "data": {
+            "player_id": player_id,
+            "seq": header.seq if header else None,
+            "timestamp": header.timestamp if header else None,
+        },
+        "round": current_round,
+    }))
+    logging.info(f"Sent player eliminated: {player_id}")
+
+async def acknowledge_frame(ws, header):
+    global frames_processed
+    frames_processed += 1
+    if header and frames_processed % ACK_INTERVAL == 0:
+        await ws.send(json.dumps({"type": "frame_ack", "data": {"seq": header.seq, "camera": header.camera}, "round": current_round}))
+
+async def eliminate_players(ws, eliminated_players, player_ids, header):
+    # Detections from every camera end up here, so each round has one merged elimination list
+    for player_id in player_ids:
+        if player_id not in all_eliminated_players and player_id <= num_players:
+            eliminated_players.append(player_id)
+            all_eliminated_players.add(player_id)
+            logging.info(f"Player {player_id} eliminated")
+            # Capture to detection latency across hosts, based on the doll's wall-clock capture timestamp
+            tracer.mark("elimination", current_round, player_id=player_id, seq=header.seq if header else None,
+                        capture_to_detect_ms=(time.time() - header.timestamp) * 1000 if header else None)
+            if STREAM_ELIMINATIONS:
+                await send_player_eliminated(ws, player_id, header)
+
+async def handle_detections(ws, eliminated_players, frame, detections, header):
+    # Runs on the event loop once a frame has been decoded and checked for motion, in frame order
+    await acknowledge_frame(ws, header)
+
+    detected_players = []
+    annotations = []
+    for label, score in detections:
+        if header and header.lane:
+            # A lane crop is scored as a single region, the lane's player is in the header
+            label, x = header.lane, 0
+        else:
+            x = motion_detector.region_of(label)[0]
+        annotations.append((f'Player {label} ({score})', x))
+        detected_players.append(label)
+
+    # Drawing and display happen on the preview thread, throttled, and only when a preview is on
+    preview.offer(frame, annotations, f"Motion Detection (lane {header.lane})" if header and header.lane else "Motion Detection")
+    await eliminate_players(ws, eliminated_players, detected_players, header)
+
+async def handle_camera_detections(ws, eliminated_players, camera, header, detections):
+    # Results from the camera worker processes, in the order they finish. Labels are already player IDs
+    await acknowledge_frame(ws, header)
+    await eliminate_players(ws, eliminated_players, [player_id for player_id, _ in detections], header)
+
+def lane_detector_for(header):
+    # Lane crops go to their lane's detector, None means the full frame detector, False a frame to drop
+    if not header.lane:
+        # The full frame detector has camera 0's lanes, other cameras' frames need the camera workers
+        return None if header.camera == 0 else False
+    lane_detector = lane_detectors.get(header.lane)
+    if lane_detector is None:
+        logging.warning(f"Dropping crop for lane {header.lane}, not in this round's lane layout")
+        return False
+    return lane_detector
+
+async def read_frame_ring(on_result, stopped):
+    # Submits frames as the doll publishes them until the stream stops and every published frame has been read.
+    # Frames are views into shared memory, nothing is copied or decoded
+    while True:
+        while (entry := frame_ring.read()) is not None:
+            index, header, pixels = entry
+            FRAMES_RECEIVED.inc()
+            if use_camera_workers:
+                camera_workers.submit(header, pixels)  # Copied, the slot may be reused before the worker gets to it
+                continue
+            lane_detector = lane_detector_for(header)
+            if lane_detector is not False:
+                await frame_pipeline.submit(pixels, on_result, header, current_round, lane_detector,
+                                            intact=functools.partial(frame_ring.is_intact, index))
+        if stopped.is_set():
+            return
+        await asyncio.sleep(RING_POLL_INTERVAL)
+
 async def backend_client(ws):
-    global is_streaming, players_info, num_players, all_eliminated_players
+    global is_streaming, player_registration, player_thumbnails, num_players, all_eliminated_players, current_round, frames_processed, frame_ring, use_camera_workers
     eliminated_players = list()
+    on_result = functools.partial(handle_detections, ws, eliminated_players)
+    previous_arrival, previous_interval = None, None
+    ring_reader, ring_stopped = None, asyncio.Event()
+    if camera_workers:
+        camera_workers.start(functools.partial(handle_camera_detections, ws, eliminated_players))
 
     while True:
         try:
             message = await ws.recv()
+
+            # Binary messages are video frames: a compact header followed by the raw JPEG bytes
+            if isinstance(message, bytes):
+                if is_streaming:
+                    FRAMES_RECEIVED.inc()
+                    BYTES_RECEIVED.inc(len(message))
+                    arrival = time.monotonic()
+                    if previous_arrival is not None:
+                        interval = arrival - previous_arrival
+                        if previous_interval is not None:
+                            FRAME_JITTER_SECONDS.observe(abs(interval - previous_interval))
+                        previous_interval = interval
+                    previous_arrival = arrival
+
+                    try:
+                        header, frame_data = unpack_frame(message)
+                    except ValueError as e:
+                        # A damaged frame, or one from a newer doll, costs that frame and not the session
+                        logging.warning(f"Dropping frame: {e}")
+                        continue
+                    logging.debug(f"Received frame {header.seq} ({header.width}x{header.height}) from camera {header.camera}")
+                    if use_camera_workers:
+                        camera_workers.submit(header, frame_data)
+                        continue
+                    lane_detector = lane_detector_for(header)
+                    if lane_detector is False:
+                        continue
+                    await frame_pipeline.submit(frame_data, on_result, header, current_round, lane_detector)
+                continue
+
             packet = json.loads(message)
 
-            if packet.get("type") == "players_info":
-                logging.info("Received players info")
-                num_players = len(packet.get("data", list()))
+            if packet.get("type") == "player_thumbnail":
+                # Registration photos arrive one per message, so no message grows with the number of players
+                player_thumbnails[int(packet["player_id"])] = packet["data"]
 
-                for player_id, player_image_data in enumerate(packet.get("data", list())):
-                    # Base64 decode the player image data
-                    player_id += 1  # Player IDs are 1-indexed
-                    player_image_data_decoded = base64.b64decode(player_image_data)
-                    with open(f"player_images/{player_id}.jpg", "wb") as f:
-                        f.write(player_image_data_decoded)
+            elif packet.get("type") == "players_info":
+                logging.info("Received players info")
+                if "data" in packet:
+                    # Every photo in one message, player IDs are 1-indexed
+                    player_images = dict(enumerate(packet["data"], start=1))
+                    num_players = len(packet["data"])
+                else:
+                    player_images = player_thumbnails
+                    num_players = packet.get("num_players", len(player_images))
+                player_thumbnails = {}
+                if num_players > MAX_NUM_PLAYERS:
+                    # The motion tracker only has lanes up to MAX_NUM_PLAYERS, the doll caps registrations the same way
+                    logging.warning(f"{num_players} players registered, only the first {MAX_NUM_PLAYERS} are watched")
+                    num_players = MAX_NUM_PLAYERS
 
-                    player_image_array = np.frombuffer(player_image_data_decoded, dtype=np.uint8)
-                    player_image = cv2.imdecode(player_image_array, cv2.IMREAD_COLOR)
-                    players_info[player_id] = player_image
-                    logging.info(f"Loaded image for player {player_id}")
+                # Loaded in the background, frames keep flowing while the photos are decoded
+                player_registration = asyncio.create_task(register_players(player_images, num_players))
 
             elif packet.get("type") == "start_video_stream":
                 logging.info("Received start video stream command")
+                try:
+                    await asyncio.wrap_future(warm_up_future)
+                except Exception as e:
+                    logging.error(f"Model warm-up failed: {e}")
+                if ring_reader is not None:
+                    ring_stopped.set()  # A previous stream that was never stopped
+                    await ring_reader
+                    ring_reader = None
+                await frame_pipeline.drain()  # Frames from a previous window must not touch the reset detector
+                if use_camera_workers:
+                    await camera_workers.drain()
                 eliminated_players.clear() # Just in case
+                previous_arrival, previous_interval = None, None
+                frames_processed = 0
+                current_round = packet.get("round")
                 is_streaming = True
-                motion_detector.first_frame = None
+                motion_detector.reset()
+                motion_tracker.reset()
                 motion_detector.set_regions(num_players)
 
+                # A lane layout maps players to (camera, x range). With camera workers each camera's full frames are processed
+                # in its own process, without them only the first camera's lanes can be watched
+                use_camera_workers = False
+                if packet.get("layout"):
+                    layout = {int(player_id): Lane(*lane) for player_id, lane in packet["layout"].items()}
+                    for player_id in [player_id for player_id in layout if player_id > MAX_NUM_PLAYERS]:
+                        logging.warning(f"Ignoring lane for player {player_id}, above MAX_NUM_PLAYERS ({MAX_NUM_PLAYERS})")
+                        del layout[player_id]
+                    camera_lanes = lanes_by_camera(layout)
+                    layout_width = packet.get("layout_width", 960)
+                    if camera_workers and not packet.get("lanes"):
+                        camera_workers.start_round(camera_lanes, layout_width)
+                        use_camera_workers = True
+                        logging.info(f"Watching {len(layout)} lanes on {len(camera_lanes)} cameras")
+                    else:
+                        if len(camera_lanes) > 1 and not packet.get("lanes"):
+                            logging.warning("Lane layout uses several cameras but CAMERA_WORKERS is not set, only camera 0 is watched and other cameras' frames are dropped")
+                        motion_detector.set_lanes(camera_lanes.get(0, []), layout_width)
+
+                # Lane layout for this round, each active lane's crop gets its own detector and reference frames
+                previous_detectors = dict(lane_detectors)
+                lane_detectors.clear()
+                for player_id, x_start, x_end in packet.get("lanes") or []:
+                    lane_detector = previous_detectors.get(player_id) or new_motion_detector()
+                    lane_detector.reset()
+                    lane_detector.set_regions(1, x_end - x_start)
+                    lane_detectors[player_id] = lane_detector
+                if lane_detectors:
+                    logging.info(f"Using lane crops for players {sorted(lane_detectors)}")
+
+                # The doll names its shared memory ring when it runs on this host, the socket then only carries control messages
+                if packet.get("shm"):
+                    try:
+                        if frame_ring is None or frame_ring.name != packet["shm"]:
+                            if frame_ring is not None:
+                                frame_ring.close()
+                            frame_ring = None
+                            frame_ring = FrameRing(packet["shm"])
+                            logging.info(f"Reading frames from shared memory ring {frame_ring.name}")
+                        frame_ring.skip_to_latest()
+                        ring_stopped.clear()
+                        ring_reader = asyncio.create_task(read_frame_ring(on_result, ring_stopped))
+                    except Exception as e:
+                        logging.error(f"Error attaching shared memory ring {packet['shm']}, is the doll on another host? {e}")
+
             elif packet.get("type") == "stop_video_stream":
                 logging.info("Received stop video stream command")
                 if is_streaming:
+                    with tracer.span("drain", current_round):
+                        if ring_reader is not None:
+                            # The doll publishes every frame before sending stop, the reader takes them all before it returns
+                            ring_stopped.set()
+                            await ring_reader
+                            ring_reader = None
+                        await frame_pipeline.drain()  # Include every frame received before the stop command
+                        if use_camera_workers:
+                            await camera_workers.drain()
+                    # With streamed eliminations this is only a summary of the window and acts as an ack
                     logging.info(f"Video stream stopped, sending eliminated players...")
                     await send_eliminated_players(ws, eliminated_players)
+                    ELIMINATIONS_PER_ROUND.observe(len(eliminated_players))
                     eliminated_players.clear()
                     is_streaming = False
-                    cv2.destroyAllWindows()  # Ensures all OpenCV windows are closed at this point
+                    preview.hide()  # Closes the preview window, if there is one, until the next stream
+                    tracer.finish_round(current_round)
 
             elif packet.get("type") == "video_frame":
                 if is_streaming:
-                    # Handle frame data
-                    frame_data = base64.b64decode(packet.get("data"))
-                    frame_array = np.frombuffer(frame_data, dtype=np.uint8)
-                    frame = cv2.imdecode(frame_array, cv2.IMREAD_COLOR)
-                    motion_contours = motion_detector.process_frame(frame)
-                    detected_players = []
-                    for contour in motion_contours:
-                        (x, y, w, h) = cv2.boundingRect(contour)
-                        label = motion_detector.get_label(contour)
-                        cv2.putText(frame, f'Player {label}', (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
-                        detected_players.append(label)
-
-                    cv2.imshow("Motion Detection", frame)
-                    cv2.waitKey(1)
-
-                    for player_id in detected_players:
-                        if player_id not in all_eliminated_players and player_id <= num_players:
-                            eliminated_players.append(player_id)
-                            all_eliminated_players.add(player_id)
-                            logging.info(f"Player {player_id} eliminated")
+                    # Legacy base64-in-JSON frames, still accepted during the rollout of binary frames
+                    FRAMES_RECEIVED.inc()
+                    BYTES_RECEIVED.inc(len(message))
+                    await frame_pipeline.submit(packet.get("data"), on_result, round_id=current_round)
 
         except websockets.exceptions.ConnectionClosedError as e:
             logging.info(f"WebSocket connection closed: {e}")
@@ -118,8 +371,33 @@ async def backend_client(ws):
             break
 
 async def main():
-    async with websockets.connect(CURRENT_SERVER_URL) as ws:
-        logging.info(f"Connected to WebSocket server at {CURRENT_SERVER_URL}")
-        await backend_client(ws)
+    global frame_pipeline, warm_up_future, camera_workers
+    if CAMERA_WORKERS:
+        # Forked first, while this is still the only thread
+        camera_workers = CameraWorkers(CAMERA_WORKERS,
+                                       {"motion_model": MOTION_MODEL, "model_scale": MOTION_MODEL_SCALE},
+                                       {"num_lanes": MAX_NUM_PLAYERS, "persist_frames": PERSIST_FRAMES, "window": PERSIST_WINDOW})
+    frame_pipeline = FramePipeline(motion_detector, tracer=tracer, motion_tracker=motion_tracker)
+    # Warm up on the detection worker, which is the thread that later uses the models
+    warm_up_future = frame_pipeline.detect_pool.submit(motion_detector.warm_up)
+    await serve_metrics(METRICS_HOST, METRICS_PORT)
+    if PREVIEW_PORT:
+        await preview.serve(PREVIEW_HOST, int(PREVIEW_PORT))
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag(EVENT_LOOP_LAG_SECONDS))
+    try:
+        async with websockets.connect(CURRENT_SERVER_URL) as ws:
+            logging.info(f"Connected to WebSocket server at {CURRENT_SERVER_URL}")
+            await backend_client(ws)
+    finally:
+        lag_monitor.cancel()
+        frame_pipeline.close()
+        preview.close()
+        player_registry.close()
+        if frame_ring is not None:
+            frame_ring.close()
+        if camera_workers is not None:
+            camera_workers.close()
+        tracer.close()
 
-asyncio.run(main())
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,121 @@
+import asyncio
+import base64
+import cv2
+import inspect
+import logging
+import numpy as np
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from shared.metrics import Counter, Histogram, LATENCY_BUCKETS
+
+FRAMES_PROCESSED = Counter("squid_frames_processed_total", "Frames decoded and checked for motion")
+FRAME_DECODE_SECONDS = Histogram("squid_frame_decode_seconds", "JPEG decode and preprocessing time per frame", LATENCY_BUCKETS)
+FRAME_DETECT_SECONDS = Histogram("squid_frame_detect_seconds", "Motion detection time per frame", LATENCY_BUCKETS)
+
+class FramePipeline:
+    """Decodes frames on a worker pool and runs motion detection on them in arrival order"""
+
+    def __init__(self, motion_detector, decode_workers=None, max_in_flight=None, tracer=None, motion_tracker=None):
+        self.motion_detector = motion_detector
+        self.tracer = tracer
+        self.motion_tracker = motion_tracker  # Optional persistence stage, only confirmed detections reach on_result
+        decode_workers = decode_workers or os.cpu_count() or 1
+        self.decode_pool = ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="decode")
+        # A single detection worker keeps the MotionDetector reference frames consistent
+        self.detect_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="detect")
+        self.max_in_flight = max_in_flight or decode_workers * 2
+        self.slots = asyncio.Semaphore(self.max_in_flight)
+        self.in_flight = deque()
+
+    def _decode(self, frame_data, motion_detector, intact):
+        # Legacy JSON frames arrive as base64 text, binary frames as raw JPEG bytes,
+        # and frames from the shared memory ring as BGR pixel views that need no decoding
+        start = time.monotonic()
+        if isinstance(frame_data, np.ndarray):
+            frame = frame_data
+        else:
+            if isinstance(frame_data, str):
+                frame_data = base64.b64decode(frame_data)
+            frame_array = np.frombuffer(frame_data, dtype=np.uint8)
+            frame = cv2.imdecode(frame_array, cv2.IMREAD_COLOR)
+        gray = motion_detector.preprocess(frame)
+        if intact is not None and not intact():
+            raise ValueError("frame was overwritten in the shared memory ring while it was read")
+        return frame, gray, start, time.monotonic()
+
+    def _detect_players(self, motion_detector, gray, header):
+        # Runs on the detect worker, the tracker needs the centroids while the detector's mask is still this frame's
+        seq = header.seq if header else None
+        detections = motion_detector.detect_players(gray, seq)
+        if self.motion_tracker is None:
+            return detections
+
+        centroids = motion_detector.lane_centroids(detections)
+        if header and header.lane:
+            # A lane crop is scored as a single region, the lane's player is in the header
+            detections = [(header.lane, score) for _, score in detections]
+            lanes = (header.lane,)
+        else:
+            lanes = motion_detector.region_labels
+        return self.motion_tracker.update(lanes, detections, centroids, seq)
+
+    async def submit(self, frame_data, on_result, header=None, round_id=None, motion_detector=None, intact=None):
+        """Queue a frame for processing, waits while the in-flight window is full.
+        Lane crops pass their lane's own motion_detector, full frames use the pipeline's.
+        Shared memory frames pass intact, which tells whether the frame's slot is still unchanged once it has been read"""
+        motion_detector = motion_detector or self.motion_detector
+        submitted_at = time.monotonic()
+        await self.slots.acquire()
+        loop = asyncio.get_running_loop()
+        decoded = loop.run_in_executor(self.decode_pool, self._decode, frame_data, motion_detector, intact)
+        previous = self.in_flight[-1] if self.in_flight else None
+        task = asyncio.create_task(self._detect(decoded, previous, on_result, header, round_id, submitted_at, motion_detector))
+        self.in_flight.append(task)
+        task.add_done_callback(self._release)
+
+    def _release(self, task):
+        self.in_flight.remove(task)
+        self.slots.release()
+
+    async def _detect(self, decoded, previous, on_result, header, round_id, submitted_at, motion_detector):
+        # Wait for the previous frame so detection and results stay in arrival order. This comes first, a frame that
+        # fails to decode must still not finish before earlier ones, or the frame after it would overtake them
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        try:
+            frame, gray, decode_start, decode_end = await decoded
+        except Exception as e:
+            logging.error(f"Error decoding frame: {e}")
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+            detect_start = time.monotonic()
+            detections = await loop.run_in_executor(self.detect_pool, self._detect_players, motion_detector, gray, header)
+            detect_end = time.monotonic()
+            result = on_result(frame, detections, header)
+            if inspect.isawaitable(result):
+                await result
+
+            FRAMES_PROCESSED.inc()
+            FRAME_DECODE_SECONDS.observe(decode_end - decode_start)
+            FRAME_DETECT_SECONDS.observe(detect_end - detect_start)
+            if self.tracer is not None:
+                seq = header.seq if header else None
+                self.tracer.record("decode", round_id, decode_start, decode_end, seq=seq)
+                self.tracer.record("detect", round_id, detect_start, detect_end, seq=seq)
+                self.tracer.record("pipeline", round_id, submitted_at, time.monotonic(), seq=seq)
+        except Exception as e:
+            logging.error(f"Error detecting motion: {e}")
+
+    async def drain(self):
+        """Wait until every submitted frame has been processed"""
+        if self.in_flight:
+            await asyncio.wait(list(self.in_flight))
+
+    def close(self):
+        self.decode_pool.shutdown(wait=False, cancel_futures=True)
+        self.detect_pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,103 @@
+import asyncio
+import cv2
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class PreviewSink:
+    """Debug preview of annotated frames, kept off the detection path. At most max_fps frames are taken,
+    only while someone is watching, and they are annotated, downscaled and encoded on a separate thread.
+    Frames go to an MJPEG endpoint (serve) and, if show_window is set, to an OpenCV window"""
+
+    def __init__(self, max_fps=5, scale=0.5, quality=70, show_window=False):
+        self.interval = 1 / max_fps
+        self.scale = scale
+        self.quality = quality
+        self.show_window = show_window
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preview")
+        self.clients = 0
+        self.busy = False  # A frame is being rendered, newer frames are dropped until it is done
+        self.last_offer = 0.0
+        self.jpeg = None
+        self.frame_ready = None  # asyncio.Event for the next rendered frame, created by serve
+
+    def offer(self, frame, annotations, title="Motion Detection"):
+        """Hand a frame to the preview, returns at once. annotations are (text, x) pairs drawn along the top edge.
+        The preview draws on its own copy, the frame itself is only read"""
+        if self.busy or not (self.clients or self.show_window):
+            return
+        now = time.monotonic()
+        if now - self.last_offer < self.interval:
+            return
+
+        self.last_offer = now
+        self.busy = True
+        rendered = asyncio.get_running_loop().run_in_executor(self.pool, self._render, frame, annotations, title)
+        rendered.add_done_callback(self._rendered)
+
+    def _render(self, frame, annotations, title):
+        # Frames can be views into the shared memory ring, so scale or copy before drawing
+        if self.scale != 1:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        else:
+            frame = frame.copy()
+        for text, x in annotations:
+            cv2.putText(frame, text, (int(x * self.scale) + 10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+        if self.show_window:
+            # Always called from the one preview thread, which is what HighGUI needs
+            cv2.imshow(title, frame)
+            cv2.waitKey(1)
+        if not self.clients:
+            return None
+        _, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return buffer.tobytes()
+
+    def _rendered(self, rendered):
+        self.busy = False
+        try:
+            jpeg = rendered.result()
+        except Exception as e:
+            logging.error(f"Error rendering preview frame: {e}")
+            return
+        if jpeg is not None and self.frame_ready is not None:
+            self.jpeg = jpeg
+            # Wake every client waiting for this frame, later waits get a fresh event
+            frame_ready, self.frame_ready = self.frame_ready, asyncio.Event()
+            frame_ready.set()
+
+    def hide(self):
+        if self.show_window:
+            self.pool.submit(cv2.destroyAllWindows)
+
+    async def _handle_client(self, reader, writer):
+        self.clients += 1
+        try:
+            await reader.readline()  # Request line, every path returns the stream
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: multipart/x-mixed-replace; boundary=frame\r\n"
+                         b"Cache-Control: no-cache\r\n"
+                         b"Connection: close\r\n\r\n")
+            while True:
+                # A slow client only falls behind itself, it always gets the latest frame
+                await self.frame_ready.wait()
+                jpeg = self.jpeg
+                writer.write(b"--frame\r\nContent-Type: image/jpeg\r\n"
+                             + f"Content-Length: {len(jpeg)}\r\n\r\n".encode() + jpeg + b"\r\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        except Exception as e:
+            logging.error(f"Error streaming preview: {e}")
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def serve(self, host, port):
+        self.frame_ready = asyncio.Event()
+        server = await asyncio.start_server(self._handle_client, host, port)
+        logging.info(f"Preview stream started on http://{host}:{port}/")
+        return server
+
+    def close(self):
+        self.hide()
+        self.pool.shutdown(wait=False, cancel_futures=True)
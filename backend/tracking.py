@@ -0,0 +1,63 @@
+import numpy as np
+
+class MotionTracker:
+    """Confirms lane motion before it counts as an elimination: a lane's motion has to persist for persist_frames
+    of the last window frames it was observed in, on one track. Each frame's motion centroid is associated with the
+    lane's previous centroid, a jump further than max_distance (in lane-normalized coordinates) starts a new track.
+    State is a few fixed-size arrays, so an update costs the same however long a round runs"""
+
+    def __init__(self, num_lanes, persist_frames=3, window=5, max_distance=0.25):
+        if not 1 <= persist_frames <= window:
+            raise ValueError("persist_frames must be between 1 and window")
+        self.num_lanes = num_lanes
+        self.persist_frames = persist_frames
+        self.window = window
+        self.max_distance = max_distance
+        self.history = np.zeros((num_lanes, window), dtype=np.bool_)  # Ring buffer of motion hits per lane
+        self.positions = np.zeros(num_lanes, dtype=np.intp)  # Next ring slot per lane
+        self.counts = np.zeros(num_lanes, dtype=np.int16)  # Hits currently in each lane's window
+        self.centroids = np.full((num_lanes, 2), np.nan, dtype=np.float32)  # Last motion centroid per lane
+        self.moving = np.zeros(num_lanes, dtype=np.bool_)
+        self.last_seq = np.full(num_lanes, -1, dtype=np.int64)  # Capture sequence number each lane was last observed at
+
+    def reset(self):
+        self.history[:] = False
+        self.positions[:] = 0
+        self.counts[:] = 0
+        self.centroids[:] = np.nan
+        self.last_seq[:] = -1
+
+    def update(self, lanes, detections, centroids, seq=None):
+        """Advance the window of every lane observed in this frame and return the detections that have persisted.
+        lanes are the labels covered by the frame, detections the (label, score) pairs from detect_players and
+        centroids their motion centroids, one row per detection. With the frame's capture sequence number as seq,
+        frames the doll held back since a lane was last observed count as frames without motion"""
+        rows = np.asarray(lanes, dtype=np.intp) - 1
+        self.moving[:] = False
+
+        if seq is not None:
+            seen = self.last_seq[rows] >= 0
+            skipped = np.where(seen, np.minimum(seq - self.last_seq[rows] - 1, self.window), 0)
+            self.last_seq[rows] = seq
+            for gap in range(1, int(skipped.max(initial=0)) + 1):
+                self._slide(rows[skipped >= gap], False)
+
+        if detections:
+            labels = np.fromiter((label for label, _ in detections), dtype=np.intp, count=len(detections)) - 1
+            # Lanes without a previous centroid have a NaN distance, which never counts as a jump
+            offsets = centroids - self.centroids[labels]
+            jumped = labels[np.hypot(offsets[:, 0], offsets[:, 1]) > self.max_distance]
+            self.history[jumped] = False
+            self.counts[jumped] = 0
+            self.centroids[labels] = centroids
+            self.moving[labels] = True
+
+        self._slide(rows, self.moving[rows])
+        return [(label, score) for label, score in detections if self.counts[label - 1] >= self.persist_frames]
+
+    def _slide(self, rows, hits):
+        # Slide each lane's window by one frame: drop the oldest hit, add this frame's
+        slots = self.positions[rows]
+        self.counts[rows] += np.asarray(hits, dtype=np.int16) - self.history[rows, slots]
+        self.history[rows, slots] = hits
+        self.positions[rows] = (slots + 1) % self.window
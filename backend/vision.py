@@ -1,28 +1,156 @@
 import time
 import cv2
 import numpy as np
+import threading
 from collections import deque
 import random
 
+# face_recognition (dlib) is only needed for match_faces and is not always installed
+try:
+    import face_recognition
+except ImportError:
+    face_recognition = None
+
+# "reference" differences against a reference frame that rotates every frames_to_persist frames,
+# "average" against a running weighted average, "mog2" uses OpenCV's mixture-of-Gaussians subtractor
+MOTION_MODELS = ("reference", "average", "mog2")
+
 class MotionDetector:
-    def __init__(self, frames_to_persist=5, min_area=750, blur_kernel=(11, 11), threshold=30):
+    def __init__(self, frames_to_persist=5, min_area=750, blur_kernel=(11, 11), threshold=30, base_height=540,
+                 motion_model="reference", model_scale=1.0, learning_rate=0.02):
+        if motion_model not in MOTION_MODELS:
+            raise ValueError(f"Unknown motion model: {motion_model}")
         self.frames_to_persist = frames_to_persist
+        # min_area and blur_kernel are tuned for base_height frames and scaled for other capture resolutions
+        self.base_height = base_height
+        self.base_min_area = min_area
         self.min_area = min_area
         self.blur_kernel = blur_kernel
         self.threshold = threshold
-        self.frame_queue = deque(maxlen=frames_to_persist)
         self.delay_counter = 0
+        self.last_seq = None  # Capture sequence number of the last frame
         self.first_frame = None
         self.next_frame = None
         self.player_regions = []
-
-    def set_regions(self, num_players):
-        self.player_regions = []
-        total_width = 960
+        self.regions_width = None
+        self.region_labels = np.zeros(0, dtype=np.intp)  # Player ID of each region
+        self.region_index = {}  # Player ID -> region index
+        self.region_starts = np.zeros(0, dtype=np.intp)
+        self.region_ends = np.zeros(0, dtype=np.intp)
+
+        # Reusable working buffers, sized from the first frame (see _ensure_buffers)
+        self.free_buffers = deque()  # Blurred grayscale frames that are no longer referenced
+        self.local = threading.local()  # Per worker thread grayscale scratch buffer for preprocess
+        self.buffer_shape = None
+        self.frame_diff = None
+        self.thresh = None
+        self.mask = None
+        self.column_sums = None
+        self.column_totals = None
+        self.region_scores = np.zeros(0, dtype=np.int32)
+
+        # Background models update in place every frame, at model_scale of the frame size
+        self.motion_model = motion_model
+        self.model_scale = model_scale
+        self.learning_rate = learning_rate
+        self.background = None  # float32 running average
+        self.background_ready = False
+        self.subtractor = None
+        self.small = None  # Downscaled frame, only when model_scale < 1
+        self.background_u8 = None
+        self.model_diff = None
+        self.model_mask = None
+
+        # Identification models, loaded on first use or by warm_up
+        self._hog = None
+        self._face_cascade = None
+
+    def set_regions(self, num_players, total_width=960):
+        # Equal lanes across the frame, player N in the Nth lane
         region_width = total_width // num_players
-        for i in range(num_players):
-            self.player_regions.append((current_index, current_index + region_width))
-            current_index += region_width
+        self.set_lanes([(player_id, (player_id - 1) * region_width, player_id * region_width) for player_id in range(1, num_players + 1)], total_width)
+
+    def set_lanes(self, lanes, total_width=960):
+        """Watch (player_id, x_start, x_end) lanes of a total_width wide frame, detections are labelled with the player IDs.
+        Lanes can have any width and leave gaps, scoring costs the same however many there are"""
+        self.regions_width = total_width
+        self.player_regions = [(max(0, x_start), min(x_end, total_width)) for _, x_start, x_end in lanes]
+        self.region_labels = np.array([player_id for player_id, _, _ in lanes], dtype=np.intp)
+        self.region_index = {player_id: index for index, (player_id, _, _) in enumerate(lanes)}
+
+        # Column range of each lane, used to sum motion per lane in one call
+        self.region_starts = np.array([start for start, _ in self.player_regions], dtype=np.intp)
+        self.region_ends = np.array([end for _, end in self.player_regions], dtype=np.intp)
+        self.region_scores = np.zeros(len(lanes), dtype=np.int32)
+
+    def region_of(self, label):
+        return self.player_regions[self.region_index[label]]
+
+    @property
+    def hog(self):
+        if self._hog is None:
+            self._hog = cv2.HOGDescriptor()
+            self._hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+        return self._hog
+
+    @property
+    def face_cascade(self):
+        if self._face_cascade is None:
+            self._face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+        return self._face_cascade
+
+    def warm_up(self, frame_size=(540, 960)):
+        # Load the models and run them once so the first red light doesn't pay for it
+        blank = np.zeros((*frame_size, 3), dtype=np.uint8)
+        self.hog.detectMultiScale(blank, winStride=(8, 8))
+        self.face_cascade.detectMultiScale(cv2.cvtColor(blank, cv2.COLOR_BGR2GRAY), scaleFactor=1.1, minNeighbors=5)
+
+    def reset(self):
+        # Forget the reference frames, their buffers go back to the pool
+        self._release_buffer(self.first_frame)
+        if self.next_frame is not self.first_frame:
+            self._release_buffer(self.next_frame)
+        self.first_frame = None
+        self.next_frame = None
+        self.delay_counter = 0
+        self.last_seq = None
+        self.background_ready = False
+        self.subtractor = None
+
+    def _acquire_buffer(self, shape):
+        # deque.pop is atomic, so decode workers can take buffers concurrently
+        try:
+            buffer = self.free_buffers.pop()
+            if buffer.shape == shape:
+                return buffer
+        except IndexError:
+            pass
+        return np.empty(shape, dtype=np.uint8)
+
+    def _release_buffer(self, buffer):
+        if buffer is not None and buffer.shape == self.buffer_shape:
+            self.free_buffers.append(buffer)
+
+    def _ensure_buffers(self, shape):
+        if self.buffer_shape == shape:
+            return
+        self.buffer_shape = shape
+        self.free_buffers.clear()
+        self.frame_diff = np.empty(shape, dtype=np.uint8)
+        self.thresh = np.empty(shape, dtype=np.uint8)
+        self.mask = np.empty(shape, dtype=np.uint8)
+        self.column_sums = np.empty((1, shape[1]), dtype=np.int32)
+        self.column_totals = np.zeros(shape[1] + 1, dtype=np.int32)  # Running sum of column_sums, after a leading zero
+
+        if self.motion_model != "reference":
+            model_shape = shape
+            if self.model_scale < 1:
+                model_shape = (max(1, int(shape[0] * self.model_scale)), max(1, int(shape[1] * self.model_scale)))
+            self.small = np.empty(model_shape, dtype=np.uint8) if model_shape != shape else None
+            self.background = np.empty(model_shape, dtype=np.float32)
+            self.background_u8 = np.empty(model_shape, dtype=np.uint8)
+            self.model_diff = np.empty(model_shape, dtype=np.uint8)
+            self.model_mask = np.empty(model_shape, dtype=np.uint8)
 
     def get_label(self, contour):
         # get centroid`` of contour
@@ -33,47 +161,150 @@ class MotionDetector:
         for i in range (len(self.player_regions)):
             region = self.player_regions[i]
             if cX >= region[0] and cX <= region[1]:
-                return i+1
-
-    def process_frame(self, frame):
-        # Convert and blur the frame
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, self.blur_kernel, 0)
+                return int(self.region_labels[i])
+
+    def blur_kernel_for(self, height):
+        # Scale the blur with the frame height, kernel sides must stay odd
+        size = max(3, int(round(self.blur_kernel[0] * height / self.base_height)) | 1)
+        return (size, size)
+
+    def _adapt_to(self, shape):
+        # The frame size changed (first frame, or the doll stepped its capture resolution):
+        # start over from a new reference frame and scale min_area with the pixel size of a player
+        self.reset()
+        self._ensure_buffers(shape)
+        self.min_area = self.base_min_area * (shape[0] / self.base_height) ** 2
+
+    def _scale_lanes(self, width):
+        # Lanes are in the pixels of the frame size they were set for, follow the capture resolution
+        ratio = width / self.regions_width
+        self.set_lanes([(int(label), int(start * ratio), int(end * ratio))
+                        for label, (start, end) in zip(self.region_labels, self.player_regions)], width)
+
+    def preprocess(self, frame):
+        # Convert and blur the frame, this step is stateless and safe to run on any worker thread.
+        # The result comes from the buffer pool and is handed back by motion_mask once it is no longer a reference
+        shape = frame.shape[:2]
+        scratch = getattr(self.local, "gray", None)
+        if scratch is None or scratch.shape != shape:
+            scratch = self.local.gray = np.empty(shape, dtype=np.uint8)
+
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=scratch)
+        gray = self._acquire_buffer(shape)
+        cv2.GaussianBlur(scratch, self.blur_kernel_for(shape[0]), 0, dst=gray)
+        return gray
+
+    def motion_mask(self, gray, seq=None):
+        # The returned mask is a working buffer that is overwritten by the next call.
+        # seq is the frame's capture sequence number, frames the doll held back still count towards the reference rotation
+        if gray.shape != self.buffer_shape:
+            self._adapt_to(gray.shape)
+        if self.player_regions and self.regions_width != gray.shape[1]:
+            self._scale_lanes(gray.shape[1])
+        if self.motion_model != "reference":
+            return self._background_mask(gray)
 
         # Initialize first frame for comparison
+        step = 1 if seq is None or self.last_seq is None else max(1, seq - self.last_seq)
+        self.last_seq = seq
         if self.first_frame is None:
             self.first_frame = gray
-            return []
+            return None
 
-        self.delay_counter += 1
+        self.delay_counter += step
         if self.delay_counter > self.frames_to_persist:
-            self.delay_counter = 0
+            # Rotate the references, the old first frame's buffer is recycled. The remainder carries over,
+            # so the rotation stays on the same captured frames whichever of them were held back
+            self.delay_counter %= self.frames_to_persist + 1
+            self._release_buffer(self.first_frame)
             self.first_frame = self.next_frame
+        elif self.next_frame is not None:
+            self._release_buffer(self.next_frame)
 
         # Set the next frame to compare (the current frame)
         self.next_frame = gray
 
         # Calculate the absolute difference between frames
-        frame_diff = cv2.absdiff(self.first_frame, self.next_frame)
-        _, thresh = cv2.threshold(frame_diff, self.threshold, 255, cv2.THRESH_BINARY)
+        cv2.absdiff(self.first_frame, self.next_frame, dst=self.frame_diff)
+        cv2.threshold(self.frame_diff, self.threshold, 255, cv2.THRESH_BINARY, dst=self.thresh)
 
         # Dilate the thresholded image to fill in holes
-        thresh = cv2.dilate(thresh, None, iterations=2)
+        cv2.dilate(self.thresh, None, dst=self.mask, iterations=2)
+        return self.mask
+
+    def _background_mask(self, gray):
+        small = gray
+        if self.small is not None:
+            cv2.resize(gray, (self.small.shape[1], self.small.shape[0]), dst=self.small, interpolation=cv2.INTER_AREA)
+            small = self.small
+
+        first = False
+        if self.motion_model == "mog2":
+            if self.subtractor is None:
+                self.subtractor = cv2.createBackgroundSubtractorMOG2(history=int(1 / self.learning_rate), varThreshold=self.threshold * 2, detectShadows=False)
+                first = True  # Everything is foreground on the subtractor's first frame
+            self.subtractor.apply(small, self.model_diff, self.learning_rate)
+        elif not self.background_ready:
+            np.copyto(self.background, small)
+            self.background_ready = True
+            first = True
+        else:
+            # Compare before updating, so a mover is not blended into the background it is compared against
+            cv2.convertScaleAbs(self.background, dst=self.background_u8)
+            cv2.absdiff(small, self.background_u8, dst=self.model_diff)
+            cv2.accumulateWeighted(small, self.background, self.learning_rate)
+            cv2.threshold(self.model_diff, self.threshold, 255, cv2.THRESH_BINARY, dst=self.model_diff)
+
+        # The model keeps its own state, so the frame's buffer can be reused right away
+        self._release_buffer(gray)
+        if first:
+            return None
+
+        if self.small is None:
+            cv2.dilate(self.model_diff, None, dst=self.mask, iterations=2)
+        else:
+            # Scale the mask back up so lanes, min_area and ROIs stay in frame coordinates
+            cv2.dilate(self.model_diff, None, dst=self.model_mask, iterations=2)
+            cv2.resize(self.model_mask, (self.mask.shape[1], self.mask.shape[0]), dst=self.mask, interpolation=cv2.INTER_NEAREST)
+        return self.mask
+
+    def detect_motion(self, gray):
+        thresh = self.motion_mask(gray)
+        if thresh is None:
+            return []
 
         # Find contours in the thresholded image
-        contours, _ = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # (findContours leaves its input untouched since OpenCV 3.2, so no copy is needed)
+        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
         # Filter out small contours
         motion_contours = [contour for contour in contours if cv2.contourArea(contour) > self.min_area]
         return motion_contours
 
-    def detect_bodies(self, frame):
-        # Use HOG descriptor or a pre-trained model to detect bodies
-        hog = cv2.HOGDescriptor()
-        hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+    def score_regions(self, thresh):
+        # Motion pixels per lane: sum each column, then difference the running column totals at each lane's edges
+        cv2.reduce(thresh, 0, cv2.REDUCE_SUM, dst=self.column_sums, dtype=cv2.CV_32S)
+        np.cumsum(self.column_sums[0], dtype=np.int32, out=self.column_totals[1:])
+        np.subtract(self.column_totals[self.region_ends], self.column_totals[self.region_starts], out=self.region_scores)
+        np.floor_divide(self.region_scores, 255, out=self.region_scores)
+        return self.region_scores
+
+    def detect_players(self, gray, seq=None):
+        # Return (player ID, motion score) for every lane with more than min_area moving pixels.
+        # Contours are only needed for debug overlays, see detect_motion
+        thresh = self.motion_mask(gray, seq)
+        if thresh is None or len(self.region_starts) == 0:
+            return []
 
-        # Detect people in the frame
-        bodies, _ = hog.detectMultiScale(frame, winStride=(8, 8))
+        scores = self.score_regions(thresh)
+        return [(int(self.region_labels[i]), int(scores[i])) for i in np.flatnonzero(scores > self.min_area)]
+
+    def process_frame(self, frame):
+        return self.detect_motion(self.preprocess(frame))
+
+    def detect_bodies(self, frame):
+        # Detect people in the frame with the cached HOG people detector
+        bodies, _ = self.hog.detectMultiScale(frame, winStride=(8, 8))
 
         return bodies
 
@@ -90,7 +321,7 @@ class MotionDetector:
             for i in range (len(self.player_regions)):
                 region = self.player_regions[i]
                 if cX >= region[0] and cX <= region[1]:
-                    regions.append(i+1)
+                    regions.append(int(self.region_labels[i]))
                     break
         return regions
 
@@ -125,16 +356,79 @@ class MotionDetector:
         return moving_bodies
 
 
-    def viz_algo(self, frame, player_images):
-        movements = self.process_frame(frame)
-        bodies = self.detect_bodies(frame)
-        movers = self.identify_movers(movements, frame)
-        self.match_faces(frame, bodies, player_images)
+    def motion_rois(self, detections, padding=32):
+        # Bounding box of the motion pixels in each moving lane, taken from the mask of the last detect_players call
+        rois = []
+        height, width = self.mask.shape
+        for label, _ in detections:
+            start, end = self.region_of(label)
+            x, y, w, h = cv2.boundingRect(self.mask[:, start:end])
+            if w == 0 or h == 0:
+                continue
+            x0, y0 = max(start + x - padding, 0), max(y - padding, 0)
+            x1, y1 = min(start + x + w + padding, width), min(y + h + padding, height)
+            rois.append((label, (x0, y0, x1 - x0, y1 - y0)))
+        return rois
+
+    def lane_centroids(self, detections):
+        # Centroid of the motion pixels in each moving lane, normalized to the lane's width and the frame height,
+        # taken from the mask of the last detect_players call
+        centroids = np.empty((len(detections), 2), dtype=np.float32)
+        height = self.mask.shape[0]
+        for index, (label, _) in enumerate(detections):
+            start, end = self.region_of(label)
+            moments = cv2.moments(self.mask[:, start:end], binaryImage=True)
+            centroids[index] = (moments["m10"] / moments["m00"] / (end - start), moments["m01"] / moments["m00"] / height)
+        return centroids
+
+    def detect_bodies_in_rois(self, frame, rois, max_roi_height=256):
+        # Run HOG on downscaled crops around the motion instead of on the full frame
+        lane_bodies = []
+        for label, (x, y, w, h) in rois:
+            crop = frame[y:y + h, x:x + w]
+            scale = min(1.0, max_roi_height / h)
+            if scale < 1.0:
+                crop = cv2.resize(crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+            # Crops smaller than the 64x128 HOG window can't be searched, the motion box stands in for the body
+            found = []
+            if crop.shape[0] >= 128 and crop.shape[1] >= 64:
+                found, _ = self.hog.detectMultiScale(crop, winStride=(8, 8))
+
+            if len(found) == 0:
+                lane_bodies.append((label, (x, y, w, h)))
+            for (bx, by, bw, bh) in found:
+                lane_bodies.append((label, (x + int(bx / scale), y + int(by / scale), int(bw / scale), int(bh / scale))))
+        return lane_bodies
+
+    def identify_motion(self, frame, detections, face_index=None):
+        """Identify who moved in the lanes reported by detect_players, must be called right after it.
+        Still frames skip body and face detection entirely"""
+        if not detections:
+            return []
+
+        lane_bodies = self.detect_bodies_in_rois(frame, self.motion_rois(detections))
 
-    def match_faces(self, frame, bodies, known_faces):
+        # All bodies from all moving lanes are matched against the face index in one batch
+        matched_players = {}
+        if face_index:
+            for result in self.match_faces(frame, [body for _, body in lane_bodies], face_index):
+                matched_players[result["body"]] = result["player_id"]
+
+        return [{"lane": label, "body": body, "player_id": matched_players.get(body)} for label, body in lane_bodies]
+
+    def viz_algo(self, frame, face_index):
+        # Cascaded identification: the cheap frame difference gates HOG and face matching
+        detections = self.detect_players(self.preprocess(frame))
+        return self.identify_motion(frame, detections, face_index)
+
+    def match_faces(self, frame, bodies, face_index):
         matched_results = []
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+        face_cascade = self.face_cascade
 
+        # Encode every detected face first, then match them all against the index in one call
+        face_bodies = []
+        face_encodings = []
         for (x, y, w, h) in bodies:
             # Crop upper region of the body where the face is expected
             body_roi = frame[y:y + h, x:x + w]
@@ -146,23 +440,23 @@ class MotionDetector:
                 face_region = face_roi[fy:fy + fh, fx:fx + fw]
 
                 # Encode the detected face
-                face_encodings = face_recognition.face_encodings(face_region)
-                if face_encodings:
-                    face_encoding = face_encodings[0]
+                face_encoding = FaceIndex.compute_embedding(face_region)
+                if face_encoding is not None:
+                    face_bodies.append((x, y, w, h))
+                    face_encodings.append(face_encoding)
 
-                    # Match with known faces
-                    matches = face_recognition.compare_faces(known_faces, face_encoding)
-                    distances = face_recognition.face_distance(known_faces, face_encoding)
+        if not face_encodings:
+            return matched_results
 
-                    # Identify the best match
-                    if matches:
-                        best_match_index = distances.argmin()
-                        matched_name = list(known_faces.keys())[best_match_index]
-                        matched_results.append({"body": (x, y, w, h), "matched_name": matched_name})
+        player_ids, distances = face_index.match(np.array(face_encodings))
+        for (x, y, w, h), player_id, distance in zip(face_bodies, player_ids, distances):
+            if player_id < 0:
+                continue
+            matched_results.append({"body": (x, y, w, h), "player_id": int(player_id), "distance": float(distance)})
 
-                        # Annotate the frame
-                        cv2.putText(frame, matched_name, (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2)
-                        cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+            # Annotate the frame
+            cv2.putText(frame, f"Player {player_id}", (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2)
+            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
 
         return matched_results
 
@@ -186,6 +480,54 @@ class MotionDetector:
         cv2.rectangle(input_frame, top_left, bottom_right, (0, 255, 0), 2)
         return input_frame, max_val
 
+class FaceIndex:
+    """Player face embeddings stored as one contiguous matrix, one row per player"""
+
+    def __init__(self, tolerance=0.6, embedding_size=128):
+        self.tolerance = tolerance
+        self.player_ids = np.zeros(0, dtype=np.int32)
+        self.embeddings = np.zeros((0, embedding_size), dtype=np.float64)
+
+    def __len__(self):
+        return len(self.player_ids)
+
+    @staticmethod
+    def compute_embedding(image):
+        # face_recognition expects RGB, OpenCV images are BGR
+        if face_recognition is None:
+            return None
+        encodings = face_recognition.face_encodings(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        return encodings[0] if encodings else None
+
+    def build(self, player_images):
+        """Compute an embedding for each {player_id: image}, players without a detectable face are skipped"""
+        player_ids = []
+        embeddings = []
+        for player_id, image in sorted(player_images.items()):
+            embedding = self.compute_embedding(image)
+            if embedding is not None:
+                player_ids.append(player_id)
+                embeddings.append(embedding)
+
+        # Swap in the finished matrices at once so concurrent readers never see a partial index
+        if embeddings:
+            self.player_ids, self.embeddings = np.array(player_ids, dtype=np.int32), np.ascontiguousarray(embeddings)
+        else:
+            self.player_ids, self.embeddings = np.zeros(0, dtype=np.int32), np.zeros((0, self.embeddings.shape[1]))
+        return len(self.player_ids)
+
+    def match(self, encodings):
+        """Return (player_ids, distances) for each row of encodings, player ID is -1 when nothing is within tolerance"""
+        player_ids, embeddings = self.player_ids, self.embeddings
+        if len(player_ids) == 0:
+            return np.full(len(encodings), -1, dtype=np.int32), np.full(len(encodings), np.inf)
+
+        # Euclidean distance of every face to every player, same metric as face_recognition.face_distance
+        distances = np.linalg.norm(encodings[:, np.newaxis, :] - embeddings[np.newaxis, :, :], axis=2)
+        best = distances.argmin(axis=1)
+        best_distances = distances[np.arange(len(encodings)), best]
+        return np.where(best_distances <= self.tolerance, player_ids[best], -1), best_distances
+
 if __name__ == "__main__":
     motion_detector = MotionDetector()
     video = cv2.VideoCapture("IMG_0699.mov")
@@ -217,14 +559,11 @@ if __name__ == "__main__":
     # time how long this takes
     start = time.time()
     # check for face matches for bodies
-    player_images = [face_recognition.face_encodings(face_recognition.load_image_file("adarsh.jpg")),
-        face_recognition.face_encodings(face_recognition.load_image_file("amanda.jpg")),
-    ]
+    face_index = FaceIndex()
+    face_index.build({1: cv2.imread("adarsh.jpg"), 2: cv2.imread("amanda.jpg")})
     print("Time to load images: ", time.time() - start)
 
-    matched_results = motion_detector.match_faces(frame, bodies, player_images)
-
-    matched_results = motion_detector.match_faces(frame, bodies, player_images)
+    matched_results = motion_detector.match_faces(frame, bodies, face_index)
     for result in matched_results:
         print(result)
 
@@ -0,0 +1,139 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import time
+import cv2
+import numpy as np
+from vision import MotionDetector
+from tracking import MotionTracker
+from shared.metrics import Counter, Histogram, LATENCY_BUCKETS
+
+CAMERA_FRAMES_PROCESSED = Counter("squid_camera_frames_processed_total", "Frames processed by the camera worker processes")
+CAMERA_FRAME_SECONDS = Histogram("squid_camera_frame_seconds", "Decode and motion detection time per frame in a camera worker", LATENCY_BUCKETS)
+
+def _camera_worker(camera, requests, results, detector_options, tracker_options):
+    # Runs in its own process for the whole game, the camera's detector and tracker state never leave it
+    motion_detector = MotionDetector(**detector_options)
+    motion_tracker = MotionTracker(**tracker_options)
+    labels = ()
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+
+        if request[0] == "frame":
+            _, header, frame_data = request
+            detections = []
+            start = time.monotonic()
+            try:
+                # Raw frames from the shared memory transport arrive as pixels, the rest as JPEG bytes
+                if isinstance(frame_data, np.ndarray):
+                    frame = frame_data
+                else:
+                    frame = cv2.imdecode(np.frombuffer(frame_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+                detections = motion_detector.detect_players(motion_detector.preprocess(frame), header.seq)
+                detections = motion_tracker.update(labels, detections, motion_detector.lane_centroids(detections), header.seq)
+            except Exception as e:
+                logging.error(f"Error detecting motion for camera {camera}: {e}")
+            # Every frame gets a result, so the parent can count frames in flight
+            results.put(("detections", camera, header, detections, time.monotonic() - start))
+
+        elif request[0] == "start":
+            _, lanes, width = request
+            motion_detector.reset()
+            motion_tracker.reset()
+            motion_detector.set_lanes(lanes, width)
+            labels = [player_id for player_id, _, _ in lanes]
+
+        elif request[0] == "drain":
+            # Requests are handled in order, so every frame submitted before this one has a result already
+            results.put(("drained", camera, request[1]))
+
+class CameraWorkers:
+    """One worker process per camera, each with its own MotionDetector and MotionTracker, so cameras are processed
+    in parallel on separate cores and a frame costs the same however many players its camera watches.
+    Results from every camera come back on one queue and are handed to on_result in arrival order"""
+
+    def __init__(self, count, detector_options=None, tracker_options=None, max_in_flight=4):
+        self.requests = [multiprocessing.Queue() for _ in range(count)]
+        self.results = multiprocessing.Queue()
+        self.max_in_flight = max_in_flight
+        self.in_flight = [0] * count
+        self.frames_dropped = 0  # Frames not queued because their camera's worker was behind
+        self.drains = {}  # Token -> future resolved when the worker reaches it
+        self.tokens = itertools.count()
+        self.collector = None
+        self.processes = []
+        for camera, requests in enumerate(self.requests):
+            process = multiprocessing.Process(target=_camera_worker, name=f"camera-{camera}", daemon=True,
+                                              args=(camera, requests, self.results, detector_options or {}, tracker_options or {}))
+            process.start()
+            self.processes.append(process)
+        logging.info(f"Started {count} camera worker processes")
+
+    def start(self, on_result):
+        """Start handing results to on_result(camera, header, detections), must be called from the event loop"""
+        self.collector = asyncio.create_task(self._collect(on_result))
+
+    def start_round(self, lanes, width):
+        """Set every camera's lanes for the next stream from {camera: [(player_id, x_start, x_end)]}"""
+        for camera, requests in enumerate(self.requests):
+            requests.put(("start", lanes.get(camera, []), width))
+
+    def submit(self, header, frame_data):
+        """Queue a frame for its camera's worker, returns False when the frame was dropped"""
+        camera = header.camera
+        if camera >= len(self.requests):
+            logging.warning(f"Dropping frame from camera {camera}, only {len(self.requests)} camera workers are running")
+            return False
+        if self.in_flight[camera] >= self.max_in_flight:
+            # This frame is the one dropped, frames already queued can't be taken back. The worker catches up on the next ones
+            self.frames_dropped += 1
+            return False
+        self.in_flight[camera] += 1
+        # The queue pickles in a background thread, so views into a WebSocket message or a shared memory slot are copied first
+        self.requests[camera].put(("frame", header, frame_data.copy() if isinstance(frame_data, np.ndarray) else bytes(frame_data)))
+        return True
+
+    async def _collect(self, on_result):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await loop.run_in_executor(None, self.results.get)
+            if message is None:
+                return
+
+            if message[0] == "detections":
+                _, camera, header, detections, seconds = message
+                self.in_flight[camera] -= 1
+                CAMERA_FRAMES_PROCESSED.inc()
+                CAMERA_FRAME_SECONDS.observe(seconds)
+                try:
+                    await on_result(camera, header, detections)
+                except Exception as e:
+                    logging.error(f"Error handling detections from camera {camera}: {e}")
+            elif message[0] == "drained":
+                drained = self.drains.pop(message[2], None)
+                if drained is not None and not drained.done():
+                    drained.set_result(None)
+
+    async def drain(self, timeout=5):
+        """Wait until the results of every frame submitted so far have been handled"""
+        loop = asyncio.get_running_loop()
+        waiting = []
+        for requests in self.requests:
+            token = next(self.tokens)
+            self.drains[token] = loop.create_future()
+            waiting.append(self.drains[token])
+            requests.put(("drain", token))
+        try:
+            await asyncio.wait_for(asyncio.gather(*waiting), timeout)
+        except asyncio.TimeoutError:
+            logging.error("Timed out waiting for the camera workers, is one of them stuck?")
+
+    def close(self):
+        for requests in self.requests:
+            requests.put(None)
+        self.results.put(None)
+        for process in self.processes:
+            process.join(1)
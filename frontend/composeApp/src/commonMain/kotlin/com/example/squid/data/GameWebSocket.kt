@@ -81,7 +81,7 @@ class GameWebSocket(
             }
 
             "eliminated_players" -> {
-                viewModel.handleEliminatedPlayers(parsedMessage.data)
+                viewModel.handleEliminatedPlayers(parsedMessage.data, parsedMessage.players)
             }
 
             "game_over" -> {
@@ -17,5 +17,6 @@ data class PlayerInfoSenderMessage(
 @Serializable
 data class ReceiverMessage(
     val type: String,
-    val data: String
+    val data: String,
+    val players: String? = null
 )
@@ -14,8 +14,10 @@ class GameViewModel : ViewModel() {
         _state.update { it.copy(endEpoch = data.toLong()) }
     }
 
-    fun handleEliminatedPlayers(data: String) {
-        val eliminatedPlayers = data.map { it.toString().toInt() }
+    fun handleEliminatedPlayers(data: String, players: String?) {
+        // players is comma separated, dolls that predate it send data with one digit per player
+        val eliminatedPlayers = players?.split(",")?.filter { it.isNotBlank() }?.map { it.trim().toInt() }
+            ?: data.map { it.toString().toInt() }
         _state.value = _state.value.copy(eliminatedPlayers = eliminatedPlayers)
     }
 
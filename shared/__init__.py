@@ -0,0 +1 @@
+# Modules used by both the doll (younghee/) and the backend (backend/). Entry points put the repository root on sys.path
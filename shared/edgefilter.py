@@ -0,0 +1,51 @@
+import cv2
+
+class EdgeFilter:
+    """The doll's edge motion pre-filter: holds back frames that barely differ from the reference frame the backend's
+    MotionDetector will compare them against. It follows the detector's reference rotation by capture sequence
+    number and always forwards the frames that become references, so the backend compares against the same frames
+    as without the filter. Check eliminations on your footage with backend/benchmark.py --edge-filter"""
+
+    def __init__(self, size=(160, 90), threshold=15, min_pixels=10, frames_to_persist=5):
+        self.size = size
+        self.threshold = threshold
+        self.min_pixels = min_pixels
+        self.frames_to_persist = frames_to_persist  # Must match the backend's MotionDetector
+        self.filtered = 0
+        self.reset()
+
+    def reset(self):
+        # The backend starts over from the first frame it receives
+        self.reference = None
+        self.candidate = None
+        self.last_seq = None
+        self.counter = 0
+
+    def passes(self, frame, seq):
+        """Return whether the frame with capture sequence number seq has to be forwarded"""
+        small = cv2.cvtColor(cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        if self.reference is None:
+            self.reference = self.candidate = small
+            self.last_seq = seq
+            self.counter = 0
+            return True
+
+        # The same counter as MotionDetector.motion_mask, on every frame the backend would get without the filter
+        step = max(1, seq - self.last_seq)
+        self.last_seq = seq
+        self.counter += step
+        if self.counter > self.frames_to_persist:
+            # The backend rotates here, its new reference is the frame before this one, which was forwarded below
+            self.counter %= self.frames_to_persist + 1
+            self.reference = self.candidate
+
+        if self.counter + step > self.frames_to_persist:
+            # The next frame is expected to rotate the backend's references onto this one
+            self.candidate = small
+            return True
+
+        _, changed = cv2.threshold(cv2.absdiff(small, self.reference), self.threshold, 255, cv2.THRESH_BINARY)
+        if cv2.countNonZero(changed) >= self.min_pixels:
+            return True
+        self.filtered += 1
+        return False
@@ -0,0 +1,123 @@
+import multiprocessing
+import os
+import struct
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+from .protocol import FrameHeader
+
+# Raw BGR video frames in a shared memory ring, for installs where the doll and the backend run on one host.
+# Layout: a 64 byte ring header, then slot_count slots of a slot header followed by slot_size bytes of pixels.
+# A slot's counter is odd while the doll writes into it and 2 * (index + 1) once frame number index is complete,
+# so the backend can tell a finished frame from one that is being overwritten.
+RING_MAGIC = b"SR"
+RING_VERSION = 2
+RING_HEADER = struct.Struct("=2sBxII")  # magic, version, slot count, slot size
+RING_HEADER_SIZE = 64
+WRITTEN = struct.Struct("=Q")  # Frames written so far, stored at WRITTEN_OFFSET
+WRITTEN_OFFSET = 16
+SLOT_HEADER = struct.Struct("=QIdHHBBHI")  # counter, frame seq, capture timestamp, width, height, lane, camera, x offset, bytes
+SLOT_COUNTER = struct.Struct("=Q")
+SLOT_ALIGNMENT = 64
+
+class FrameRing:
+    """Single producer ring of raw frames. The doll creates it and writes, the backend attaches and reads
+    frames as NumPy views into the shared memory"""
+
+    def __init__(self, name, create=False, slot_count=16, slot_size=960 * 540 * 3):
+        self.name = name
+        self.owner = create
+        if create:
+            # A ring left behind by a crashed run would have the wrong size or stale frames
+            try:
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+            except FileNotFoundError:
+                pass
+            stride = self._stride(slot_size)
+            self.memory = shared_memory.SharedMemory(name=name, create=True, size=RING_HEADER_SIZE + slot_count * stride)
+            RING_HEADER.pack_into(self.memory.buf, 0, RING_MAGIC, RING_VERSION, slot_count, slot_size)
+            WRITTEN.pack_into(self.memory.buf, WRITTEN_OFFSET, 0)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            # Only the creator may unlink the segment, the resource tracker would otherwise remove it when we exit.
+            # Processes started by multiprocessing share their parent's tracker, unregistering there would drop the
+            # creator's registration. The tracker only runs on POSIX, where it knows the segment by its "/" path
+            if os.name == "posix" and multiprocessing.parent_process() is None:
+                resource_tracker.unregister("/" + self.memory.name.lstrip("/"), "shared_memory")
+            magic, version, slot_count, slot_size = RING_HEADER.unpack_from(self.memory.buf, 0)
+            if magic != RING_MAGIC or version != RING_VERSION:
+                self.memory.close()
+                raise ValueError(f"Unsupported frame ring {name} (magic={magic}, version={version})")
+
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.stride = self._stride(slot_size)
+        self.frames_written = WRITTEN.unpack_from(self.memory.buf, WRITTEN_OFFSET)[0]
+        self.read_index = self.frames_written
+        self.frames_lapped = 0  # Frames overwritten before the reader got to them
+
+    @staticmethod
+    def _stride(slot_size):
+        size = SLOT_HEADER.size + slot_size
+        return (size + SLOT_ALIGNMENT - 1) // SLOT_ALIGNMENT * SLOT_ALIGNMENT
+
+    def _slot_offset(self, index):
+        return RING_HEADER_SIZE + (index % self.slot_count) * self.stride
+
+    def write(self, seq, timestamp, pixels, lane=0, x_offset=0, camera=0):
+        """Copy a frame (a BGR array or a crop of one) into the next slot and publish it, False if it doesn't fit"""
+        height, width = pixels.shape[:2]
+        if pixels.nbytes > self.slot_size:
+            return False
+
+        index = self.frames_written
+        offset = self._slot_offset(index)
+        buffer = self.memory.buf
+        SLOT_COUNTER.pack_into(buffer, offset, 2 * index + 1)
+        np.copyto(np.ndarray(pixels.shape, dtype=np.uint8, buffer=buffer, offset=offset + SLOT_HEADER.size), pixels)
+        SLOT_HEADER.pack_into(buffer, offset, 2 * index + 2, seq, timestamp, width, height, lane, camera, x_offset, pixels.nbytes)
+        self.frames_written = index + 1
+        WRITTEN.pack_into(buffer, WRITTEN_OFFSET, self.frames_written)
+        return True
+
+    def skip_to_latest(self):
+        """Ignore every frame written so far, the next read returns the next frame the doll writes"""
+        self.read_index = WRITTEN.unpack_from(self.memory.buf, WRITTEN_OFFSET)[0]
+
+    def read(self):
+        """Return (index, header, pixels) for the next unread frame, or None when there is none.
+        pixels is a view into shared memory and stays valid until the doll laps the ring, check with is_intact"""
+        buffer = self.memory.buf
+        written = WRITTEN.unpack_from(buffer, WRITTEN_OFFSET)[0]
+        while self.read_index < written:
+            if written - self.read_index > self.slot_count:
+                # The doll has lapped us, the oldest frames are gone
+                self.frames_lapped += written - self.slot_count - self.read_index
+                self.read_index = written - self.slot_count
+
+            index = self.read_index
+            self.read_index += 1
+            offset = self._slot_offset(index)
+            counter, seq, timestamp, width, height, lane, camera, x_offset, _ = SLOT_HEADER.unpack_from(buffer, offset)
+            if counter != 2 * index + 2:
+                self.frames_lapped += 1
+                continue
+            pixels = np.ndarray((height, width, 3), dtype=np.uint8, buffer=buffer, offset=offset + SLOT_HEADER.size)
+            return index, FrameHeader(seq, timestamp, width, height, lane, x_offset, camera), pixels
+        return None
+
+    def is_intact(self, index):
+        """True while frame number index has not been overwritten"""
+        return SLOT_COUNTER.unpack_from(self.memory.buf, self._slot_offset(index))[0] == 2 * index + 2
+
+    def close(self):
+        try:
+            self.memory.close()
+        except BufferError:
+            pass  # Frame views are still alive, the mapping goes away with them
+        if self.owner:
+            try:
+                self.memory.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,36 @@
+import json
+from collections import namedtuple
+
+# Lane layout: which camera watches each player, and which columns of that camera's frames are the player's lane.
+# A layout file looks like
+#   {"width": 960,
+#    "cameras": ["/dev/video0", "/dev/video2"],
+#    "lanes": {"1": [0, 0, 80], "2": [0, 80, 160], ..., "24": [1, 880, 960]}}
+# with lanes as [camera index, x start, x end] in pixels of a width wide frame.
+
+Lane = namedtuple("Lane", ["camera", "x_start", "x_end"])
+
+def load_layout(path):
+    """Return (width, camera devices, {player_id: Lane}) from a layout file"""
+    with open(path) as f:
+        config = json.load(f)
+
+    width = config.get("width", 960)
+    cameras = config.get("cameras") or [0]
+    lanes = {int(player_id): Lane(*lane) for player_id, lane in config["lanes"].items()}
+    for player_id, lane in lanes.items():
+        if not 0 <= lane.camera < len(cameras) or not 0 <= lane.x_start < lane.x_end <= width:
+            raise ValueError(f"Invalid lane for player {player_id}: {list(lane)}")
+    return width, cameras, lanes
+
+def equal_lanes(num_players, width=960):
+    # The single camera layout: the frame width split equally between the players, player N in the Nth lane
+    lane_width = width // num_players
+    return {player_id: Lane(0, (player_id - 1) * lane_width, player_id * lane_width) for player_id in range(1, num_players + 1)}
+
+def lanes_by_camera(lanes):
+    """Group {player_id: Lane} into {camera: [(player_id, x_start, x_end)]}, ordered left to right"""
+    cameras = {}
+    for player_id, (camera, x_start, x_end) in sorted(lanes.items(), key=lambda item: (item[1].camera, item[1].x_start)):
+        cameras.setdefault(camera, []).append((player_id, x_start, x_end))
+    return cameras
@@ -0,0 +1,122 @@
+import asyncio
+import bisect
+import logging
+import time
+
+# Minimal Prometheus text-format metrics, served over plain HTTP with asyncio.
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+class Counter:
+    """A counter is either incremented directly or read from a function that returns a running total"""
+    type = "counter"
+
+    def __init__(self, name, help, function=None, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+        registry.register(self)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        return [f"{self.name} {value}"]
+
+class Gauge:
+    """A gauge is either set directly or read from a function at scrape time, which costs nothing on the hot path"""
+    type = "gauge"
+
+    def __init__(self, name, help, function=None, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+        registry.register(self)
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                value = float("nan")
+        return [f"{self.name} {value}"]
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, buckets, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        registry.register(self)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+# Bucket bounds in seconds for latencies from sub-millisecond to a few seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+async def _handle_scrape(reader, writer, registry):
+    try:
+        await reader.readline()  # Request line, every path returns the metrics
+        body = registry.expose().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: text/plain; version=0.0.4\r\n"
+                     + f"Content-Length: {len(body)}\r\n".encode()
+                     + b"Connection: close\r\n\r\n" + body)
+        await writer.drain()
+    except Exception as e:
+        logging.error(f"Error serving metrics: {e}")
+    finally:
+        writer.close()
+
+async def serve_metrics(host, port, registry=REGISTRY):
+    server = await asyncio.start_server(lambda reader, writer: _handle_scrape(reader, writer, registry), host, port)
+    logging.info(f"Metrics endpoint started on http://{host}:{port}/metrics")
+    return server
+
+async def monitor_event_loop_lag(histogram, interval=0.1):
+    # How late the loop wakes a sleeping task is how long other callbacks held it
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, time.monotonic() - start - interval))
@@ -0,0 +1,69 @@
+import asyncio
+import base64
+import logging
+import os
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+class PlayerRegistry:
+    """Registration headshots by player ID, held in memory. Photos are decoded and downscaled on a thread pool
+    (OpenCV releases the GIL), and only written to disk when persist_dir is set, in the background"""
+
+    def __init__(self, max_side=480, quality=85, persist_dir=None, workers=4):
+        self.max_side = max_side  # Longest side of the stored images and thumbnails, plenty for face embeddings
+        self.quality = quality
+        self.persist_dir = persist_dir
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="register")
+        self.images = {}  # Player ID -> BGR image
+        self.thumbnails = {}  # Player ID -> JPEG bytes, small enough to forward to the backend
+
+    def _load(self, encoded):
+        data = base64.b64decode(encoded)
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("not a decodable image")
+
+        height, width = image.shape[:2]
+        scale = self.max_side / max(height, width)
+        if scale >= 1:
+            return data, image, data  # Already small, forwarded as received
+        image = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        _, thumbnail = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return data, image, thumbnail.tobytes()
+
+    def _persist(self, player_id, data):
+        try:
+            os.makedirs(self.persist_dir, exist_ok=True)
+            with open(os.path.join(self.persist_dir, f"{player_id}.jpg"), "wb") as f:
+                f.write(data)
+        except Exception as e:
+            logging.error(f"Error saving image for player {player_id}: {e}")
+
+    async def register(self, encoded_images):
+        """Replace the registered players with {player_id: base64 JPEG}, returns the number of images loaded"""
+        loop = asyncio.get_running_loop()
+        player_ids = sorted(encoded_images)
+        results = await asyncio.gather(*(loop.run_in_executor(self.pool, self._load, encoded_images[player_id]) for player_id in player_ids),
+                                       return_exceptions=True)
+
+        images, thumbnails = {}, {}
+        for player_id, result in zip(player_ids, results):
+            if isinstance(result, Exception):
+                logging.error(f"Error loading image for player {player_id}: {result}")
+                continue
+            data, images[player_id], thumbnails[player_id] = result
+            if self.persist_dir:
+                self.pool.submit(self._persist, player_id, data)  # The original photo, not the thumbnail
+        # Swapped in at once, readers never see a mix of two registrations
+        self.images, self.thumbnails = images, thumbnails
+        return len(images)
+
+    def encoded_thumbnails(self, num_players):
+        """Base64 thumbnails for players 1 to num_players, in the mobile app's players_info format"""
+        return [base64.b64encode(self.thumbnails[player_id]).decode("utf-8") if player_id in self.thumbnails else ""
+                for player_id in range(1, num_players + 1)]
+
+    def close(self):
+        # Waits for pending writes
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,45 @@
+import struct
+from collections import namedtuple
+
+# Binary video frame layout (big-endian), followed directly by the raw JPEG bytes:
+#   magic (2s) | version (B) | sequence number (I) | capture timestamp (d) | width (H) | height (H)
+# Version 2 frames carry a single lane crop and append:
+#   lane player ID (B) | x offset of the crop in the full frame (H)
+# Version 3 frames come from one of several cameras and append to the version 2 layout:
+#   camera index (B)
+FRAME_MAGIC = b"SQ"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!2sBIdHH")
+LANE_FRAME_VERSION = 2
+LANE_FRAME_HEADER = struct.Struct("!2sBIdHHBH")
+CAMERA_FRAME_VERSION = 3
+CAMERA_FRAME_HEADER = struct.Struct("!2sBIdHHBHB")
+LAYOUTS = {FRAME_VERSION: FRAME_HEADER, LANE_FRAME_VERSION: LANE_FRAME_HEADER, CAMERA_FRAME_VERSION: CAMERA_FRAME_HEADER}
+
+# lane is 0 for a full frame, camera is 0 for the first (or only) camera
+FrameHeader = namedtuple("FrameHeader", ["seq", "timestamp", "width", "height", "lane", "x_offset", "camera"], defaults=(0, 0, 0))
+
+def pack_frame(seq, timestamp, width, height, jpeg_bytes, lane=0, x_offset=0, camera=0):
+    # Frames use the oldest layout that holds them, so single camera installs keep working with older backends
+    if camera:
+        header = CAMERA_FRAME_HEADER.pack(FRAME_MAGIC, CAMERA_FRAME_VERSION, seq, timestamp, width, height, lane, x_offset, camera)
+    elif lane:
+        header = LANE_FRAME_HEADER.pack(FRAME_MAGIC, LANE_FRAME_VERSION, seq, timestamp, width, height, lane, x_offset)
+    else:
+        header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, seq, timestamp, width, height)
+    return b"".join((header, memoryview(jpeg_bytes)))
+
+def unpack_frame(message):
+    if len(message) < FRAME_HEADER.size:
+        raise ValueError(f"Binary frame too short: {len(message)} bytes")
+
+    magic, version = message[:2], message[2]
+    if magic != FRAME_MAGIC or version not in LAYOUTS:
+        raise ValueError(f"Unsupported binary frame (magic={magic}, version={version})")
+
+    layout = LAYOUTS[version]
+    if len(message) < layout.size:
+        raise ValueError(f"Binary frame too short: {len(message)} bytes")
+
+    # The payload is a view into the message, no copy is made
+    return FrameHeader(*layout.unpack_from(message)[2:]), memoryview(message)[layout.size:]
@@ -0,0 +1,72 @@
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds in milliseconds, the last bucket counts everything above
+HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class Tracer:
+    """Records spans stamped with time.monotonic() and appends them to a JSONL trace file.
+    Spans carry the round ID shared by the doll and the backend, so the two files can be joined per round.
+    Tracing is off, and every call is a no-op, when no path is given"""
+
+    def __init__(self, path, process):
+        self.path = path
+        self.process = process
+        self.enabled = bool(path)
+        self.file = None
+        self.round_totals = defaultdict(lambda: defaultdict(float))
+        self.histograms = defaultdict(lambda: [0] * (len(HISTOGRAM_BUCKETS_MS) + 1))
+
+    def _write(self, entry):
+        if self.file is None:
+            self.file = open(self.path, "a")
+            logging.info(f"Writing trace to {self.path}")
+        self.file.write(json.dumps(entry) + "\n")
+
+    def record(self, name, round_id, start, end, **attributes):
+        """Record a span from two time.monotonic() values"""
+        if not self.enabled:
+            return
+        duration_ms = (end - start) * 1000
+        self.round_totals[round_id][name] += duration_ms
+        histogram = self.histograms[name]
+        for index, bound in enumerate(HISTOGRAM_BUCKETS_MS):
+            if duration_ms <= bound:
+                histogram[index] += 1
+                break
+        else:
+            histogram[-1] += 1
+        self._write({"type": "span", "process": self.process, "round": round_id, "name": name,
+                     "start": start, "end": end, "duration_ms": duration_ms, **attributes})
+
+    @contextmanager
+    def span(self, name, round_id, **attributes):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, round_id, start, time.monotonic(), **attributes)
+
+    def mark(self, name, round_id, **attributes):
+        """Record an instant event, with wall-clock time so events can be lined up across hosts"""
+        if self.enabled:
+            self._write({"type": "mark", "process": self.process, "round": round_id, "name": name,
+                         "time": time.monotonic(), "wall_time": time.time(), **attributes})
+
+    def finish_round(self, round_id):
+        """Write the round's per-span latency breakdown and the cumulative histograms, then flush"""
+        if not self.enabled:
+            return
+        self._write({"type": "round", "process": self.process, "round": round_id,
+                     "breakdown_ms": dict(self.round_totals.pop(round_id, {}))})
+        self._write({"type": "histograms", "process": self.process, "round": round_id,
+                     "buckets_ms": list(HISTOGRAM_BUCKETS_MS), "counts": dict(self.histograms)})
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
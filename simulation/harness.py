@@ -0,0 +1,272 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import runpy
+import signal
+import sys
+import time
+import wave
+import cv2
+import numpy as np
+import websockets
+
+# Plays whole games on localhost with no Pi, camera, speaker or phone: each game is a doll (younghee/main.py with
+# the stand-ins from stand_ins.py) and a backend (backend/main.py, unmodified) in their own processes, driven by a
+# scripted mobile app client. Several games run at once to put the machine under sustained load.
+#   python simulation/harness.py --games 4 --players 8 --repeat 3
+# Settings for the doll and the backend, such as SHARED_MEMORY_FRAMES or MOTION_MODEL, are passed through from the
+# environment. Logs and trace files go to --output.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOLL_DIR = os.path.join(ROOT, "younghee")
+BACKEND_DIR = os.path.join(ROOT, "backend")
+
+def run_doll():
+    # The doll subprocess, its own modules take precedence over anything next to this file
+    sys.path.insert(0, DOLL_DIR)
+    import stand_ins
+    stand_ins.install()
+    runpy.run_path(os.path.join(DOLL_DIR, "main.py"), run_name="__main__")
+
+def clip_length(file_name):
+    with wave.open(os.path.join(DOLL_DIR, "audio", file_name)) as clip:
+        return clip.getnframes() / clip.getframerate()
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "max": None}
+    values = sorted(values)
+    return {"p50": values[len(values) // 2], "p95": values[min(len(values) - 1, int(len(values) * 0.95))], "max": values[-1]}
+
+def histogram_summary(metrics, name):
+    # Mean and approximate p99 from a Prometheus histogram's cumulative buckets
+    count = metrics.get(f"{name}_count", 0)
+    if not count:
+        return {"mean_ms": None, "p99_ms": None}
+    p99 = None
+    for key, cumulative in metrics.items():
+        if key.startswith(f"{name}_bucket") and cumulative >= 0.99 * count:
+            bound = key.split('le="')[1].rstrip('"}')
+            if bound != "+Inf" and (p99 is None or float(bound) < p99):
+                p99 = float(bound)
+    return {"mean_ms": metrics[f"{name}_sum"] / count * 1000, "p99_ms": p99 * 1000 if p99 is not None else None}
+
+async def scrape(port):
+    """Return {sample: value} from a metrics endpoint, empty when it is not reachable"""
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        await writer.drain()
+        response = (await reader.read()).decode()
+        writer.close()
+    except OSError:
+        return {}
+    metrics = {}
+    for line in response.split("\r\n\r\n", 1)[-1].splitlines():
+        if line and not line.startswith("#"):
+            sample, value = line.rsplit(" ", 1)
+            metrics[sample] = float(value)
+    return metrics
+
+async def wait_for_port(port, process, log_path, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.returncode is not None:
+            raise RuntimeError(f"Process exited with {process.returncode}, see {log_path}")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s, see {log_path}")
+
+def synthetic_photo(width=1200, height=1600, quality=90):
+    # About the size of a phone headshot, noise keeps the JPEG from compressing away
+    image = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    _, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return base64.b64encode(buffer).decode("utf-8")
+
+class SimulatedGame:
+    """One doll and backend pair on its own ports, played by a scripted mobile app client"""
+
+    def __init__(self, index, args):
+        self.index = index
+        self.args = args
+        base_port = args.base_port + 10 * index
+        self.mobile_app_port, self.backend_port = base_port, base_port + 1
+        self.doll_metrics_port, self.backend_metrics_port = base_port + 2, base_port + 3
+        self.doll_trace = os.path.join(args.output, f"game{index}-doll-trace.jsonl")
+        self.processes = []
+        self.log_paths = []  # (name, log path) of each process
+        self.logs = []
+        self.games_played = 0
+        self.eliminations = 0  # Over every game played
+        self.registration_seconds = []  # players_info sent -> game end time received
+
+    async def _spawn(self, name, command, cwd, environment):
+        log_path = os.path.join(self.args.output, f"game{self.index}-{name}.log")
+        log = open(log_path, "w")
+        self.logs.append(log)
+        process = await asyncio.create_subprocess_exec(*command, cwd=cwd, env=environment, stdout=log, stderr=log)
+        self.processes.append(process)
+        self.log_paths.append((name, log_path))
+        return process, log_path
+
+    async def watch(self, interval=0.5):
+        # Raises as soon as the doll or the backend exits, a game without them would only end at the timeout
+        while True:
+            for process, (name, log_path) in zip(self.processes, self.log_paths):
+                if process.returncode is not None:
+                    raise RuntimeError(f"The {name} exited with {process.returncode}, see {log_path}")
+            await asyncio.sleep(interval)
+
+    async def start(self):
+        if os.path.exists(self.doll_trace):
+            os.remove(self.doll_trace)  # The tracer appends, rounds from an earlier run would skew the report
+        environment = {**os.environ, "RPI_IP": "127.0.0.1", "EVIN_IP": "127.0.0.1", "BACKEND_PORT": str(self.backend_port),
+                       "MOBILE_APP_PORT": str(self.mobile_app_port), "SHARED_MEMORY_NAME": f"squid-frames-sim{self.index}"}
+        doll, doll_log = await self._spawn("doll", [sys.executable, os.path.abspath(__file__), "--doll"], DOLL_DIR, {
+            **environment, "METRICS_PORT": str(self.doll_metrics_port), "TRACE_FILE": os.path.abspath(self.doll_trace),
+            "SIM_PLAYERS": str(self.args.players), "SIM_FPS": str(self.args.fps), "SIM_MOTION": str(self.args.motion),
+            "SIM_SEED": str(self.index), **({"SIM_CLIP": os.path.abspath(self.args.clip)} if self.args.clip else {})})
+        await wait_for_port(self.mobile_app_port, doll, doll_log)  # Both of the doll's servers start together
+
+        backend, backend_log = await self._spawn("backend", [sys.executable, "main.py"], BACKEND_DIR, {
+            **environment, "METRICS_PORT": str(self.backend_metrics_port), "SHOW_WINDOW": "0"})
+        await wait_for_port(self.backend_metrics_port, backend, backend_log)
+        await asyncio.sleep(1)  # The backend connects to the doll right after its metrics endpoint is up
+
+    async def play(self, photo):
+        # Speaks the mobile app's side of the protocol, a new game is registered once the doll is free again
+        rest_after_game = clip_length("game_end.wav") + 1
+        async with websockets.connect(f"ws://127.0.0.1:{self.mobile_app_port}", max_size=None) as ws:
+            for _ in range(self.args.repeat):
+                registered_at = time.monotonic()
+                eliminated = 0
+                await ws.send(json.dumps({"type": "players_info", "data": [photo] * self.args.players}))
+                async for message in ws:
+                    packet = json.loads(message)
+                    if packet.get("type") == "game_end_time":
+                        self.registration_seconds.append(time.monotonic() - registered_at)
+                    elif packet.get("type") == "eliminated_players":
+                        eliminated = len([player_id for player_id in packet["players"].split(",") if player_id])
+                    elif packet.get("type") == "game_over":
+                        self.games_played += 1
+                        self.eliminations += eliminated
+                        break
+                await asyncio.sleep(rest_after_game)
+
+    def round_latencies(self):
+        # Round duration from the red light to the eliminations arriving back at the doll, and the backend turnaround
+        rounds = {}
+        try:
+            with open(self.doll_trace) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if entry.get("type") == "span" and entry["name"] in ("red_light", "await_eliminations"):
+                        rounds.setdefault(entry["round"], {})[entry["name"]] = entry
+        except FileNotFoundError:
+            return [], []
+        complete = [spans for spans in rounds.values() if len(spans) == 2]
+        return ([spans["await_eliminations"]["end"] - spans["red_light"]["start"] for spans in complete],
+                [spans["await_eliminations"]["duration_ms"] / 1000 for spans in complete])
+
+    async def report(self):
+        doll, backend = await scrape(self.doll_metrics_port), await scrape(self.backend_metrics_port)
+        round_seconds, turnaround_seconds = self.round_latencies()
+        return {"game": self.index, "games_played": self.games_played, "rounds": len(round_seconds),
+                "round_seconds": percentiles(round_seconds), "turnaround_seconds": percentiles(turnaround_seconds),
+                "registration_seconds": percentiles(self.registration_seconds), "eliminations": self.eliminations,
+                "frames_sent": doll.get("squid_frames_sent_total", 0), "frames_received": backend.get("squid_frames_received_total", 0),
+                "frames_dropped": doll.get("squid_frames_dropped_total", 0) + backend.get("squid_ring_frames_lapped_total", 0),
+                "doll_loop_lag": histogram_summary(doll, "squid_event_loop_lag_seconds"),
+                "backend_loop_lag": histogram_summary(backend, "squid_event_loop_lag_seconds")}
+
+    async def stop(self):
+        # SIGINT lets both processes run their cleanup, the doll unlinks its shared memory ring
+        for process in self.processes:
+            if process.returncode is None:
+                process.send_signal(signal.SIGINT)
+        for process in self.processes:
+            try:
+                await asyncio.wait_for(process.wait(), 10)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        for log in self.logs:
+            log.close()
+
+async def run_game(game, photo, timeout):
+    try:
+        await game.start()
+        play = asyncio.ensure_future(asyncio.wait_for(game.play(photo), timeout))
+        watch = asyncio.ensure_future(game.watch())
+        try:
+            await asyncio.wait([play, watch], return_when=asyncio.FIRST_COMPLETED)
+            if play.done() and play.exception() is not None and not isinstance(play.exception(), asyncio.TimeoutError):
+                # A dead process usually shows up as a closed connection first, give it a moment to be reaped
+                await asyncio.wait([watch], timeout=1)
+            if watch.done():
+                watch.result()
+            play.result()
+        finally:
+            play.cancel()
+            watch.cancel()
+    except Exception as e:
+        print(f"Game {game.index} failed: {e!r}", file=sys.stderr)
+    try:
+        return await game.report()
+    finally:
+        await game.stop()
+
+async def run(args):
+    os.makedirs(args.output, exist_ok=True)
+    if args.photo:
+        with open(args.photo, "rb") as f:
+            photo = base64.b64encode(f.read()).decode("utf-8")
+    else:
+        photo = synthetic_photo()
+    games = [SimulatedGame(index, args) for index in range(args.games)]
+    return await asyncio.gather(*(run_game(game, photo, args.timeout) for game in games))
+
+def print_reports(reports):
+    def ms(value):
+        return f"{value * 1000:.0f}" if value is not None else "-"
+
+    def lag(summary):
+        return f"{summary['mean_ms']:.1f}/{summary['p99_ms']:.0f}" if summary["p99_ms"] is not None else "-"
+
+    print(f"{'game':<6}{'played':>8}{'rounds':>8}{'round p50 ms':>14}{'round p95 ms':>14}{'turnaround p95':>16}"
+          f"{'sent':>8}{'dropped':>9}{'doll lag mean/p99':>19}{'backend lag mean/p99':>22}")
+    for report in reports:
+        print(f"{report['game']:<6}{report['games_played']:>8}{report['rounds']:>8}{ms(report['round_seconds']['p50']):>14}"
+              f"{ms(report['round_seconds']['p95']):>14}{ms(report['turnaround_seconds']['p95']):>16}{report['frames_sent']:>8.0f}"
+              f"{report['frames_dropped']:>9.0f}{lag(report['doll_loop_lag']):>19}{lag(report['backend_loop_lag']):>22}")
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--doll"]:
+        run_doll()
+        sys.exit()
+
+    parser = argparse.ArgumentParser(description="Play simulated games on localhost and report latency under load")
+    parser.add_argument("--games", type=int, default=2, help="Games to run at once, each with its own doll and backend")
+    parser.add_argument("--players", type=int, default=4, help="Players registered in each game")
+    parser.add_argument("--repeat", type=int, default=1, help="Games played back to back on each doll")
+    parser.add_argument("--fps", type=float, default=30, help="Frame rate of the simulated cameras")
+    parser.add_argument("--clip", help="Video to replay as the camera feed, for example backend/IMG_0699.mov, synthetic players when unset")
+    parser.add_argument("--motion", type=float, default=0.3, help="Chance that a synthetic player moves during each 4 second phase")
+    parser.add_argument("--photo", help="Headshot to register every player with, a synthetic phone-sized photo when unset")
+    parser.add_argument("--base-port", type=int, default=9100, help="First port, each game uses the next 10")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds before a game's client gives up")
+    parser.add_argument("--output", default="simulation-output", help="Directory for process logs and trace files")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    reports = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print_reports(reports)
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import math
+import os
+import random
+import sys
+import time
+import types
+import wave
+import cv2
+import numpy as np
+
+# Stand-ins for the doll's hardware, so younghee/main.py runs unmodified on any machine.
+# install() must run with younghee/ first on sys.path and before younghee/main.py is imported.
+
+class ClipSource:
+    """Stands in for cv2.VideoCapture, delivering frames at a steady rate like a sensor would. Replays a video
+    file in a loop, or draws one figure per lane, some of which move during each phase of phase_seconds"""
+
+    def __init__(self, path=None, fps=30, size=(960, 540), num_players=4, motion=0.3, phase_seconds=4, seed=0):
+        self.clip = cv2.VideoCapture(path) if path else None
+        if self.clip is not None and not self.clip.isOpened():
+            raise ValueError(f"Could not open clip {path}")
+        self.fps = fps
+        self.size = size
+        self.num_players = num_players
+        self.motion = motion
+        self.phase_seconds = phase_seconds
+        self.seed = seed
+        self.next_frame_at = time.monotonic()
+        # Fixed noise so the motion models see a textured, static background
+        self.background = np.random.default_rng(seed).integers(90, 150, (size[1], size[0], 3), dtype=np.uint8)
+
+    def isOpened(self):
+        return True
+
+    def set(self, prop, value):
+        return False  # Like a driver ignoring a setting, the caller reads back the real value
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.size[0]
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.size[1]
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        return 0
+
+    def _synthetic(self, now):
+        frame = self.background.copy()
+        lane_width = self.size[0] // self.num_players
+        phase = int(now / self.phase_seconds)
+        for lane in range(self.num_players):
+            x = lane * lane_width + lane_width // 2
+            if random.Random(f"{self.seed}-{lane}-{phase}").random() < self.motion:
+                x += int(lane_width * 0.2 * math.sin(now * 8 + lane))
+            cv2.rectangle(frame, (x - lane_width // 6, self.size[1] // 3), (x + lane_width // 6, self.size[1] - 20), (30, 30, 30), -1)
+        return frame
+
+    def read(self):
+        delay = self.next_frame_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        now = time.monotonic()
+        # A consumer that falls behind gets the next frame straight away, it does not get a burst of them
+        self.next_frame_at = max(self.next_frame_at, now) + 1 / self.fps
+
+        if self.clip is None:
+            return True, self._synthetic(now)
+        ret, frame = self.clip.read()
+        if not ret:
+            self.clip.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.clip.read()
+        if ret and (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        return ret, frame
+
+    def grab(self):
+        return self.read()[0]
+
+    def release(self):
+        if self.clip is not None:
+            self.clip.release()
+
+class SimulatedAudio:
+    """Stands in for audio.Audio without pygame, each clip takes as long as the WAV file would play"""
+
+    def __init__(self, audio_dir="audio"):
+        self.durations = {}
+        self.last_announcement = None
+
+    def duration(self, file_path):
+        file_path = os.path.normpath(file_path)
+        if file_path not in self.durations:
+            try:
+                with wave.open(file_path) as clip:
+                    self.durations[file_path] = clip.getnframes() / clip.getframerate()
+            except Exception as e:
+                logging.error(f"Error reading audio clip {file_path}: {e}")
+                self.durations[file_path] = 0
+        return self.durations[file_path]
+
+    async def play(self, file_path):
+        await asyncio.sleep(self.duration(file_path))
+
+    def announce(self, file_paths):
+        # Announcements play back to back, like on the reserved channel
+        previous = self.last_announcement
+
+        async def play_after_previous():
+            if previous is not None:
+                await previous
+            await asyncio.sleep(sum(self.duration(file_path) for file_path in file_paths))
+
+        self.last_announcement = asyncio.ensure_future(play_after_previous())
+        return self.last_announcement
+
+def install():
+    """Swap the stand-ins in for the doll's hardware modules, configured by the SIM_* environment variables"""
+    import camera
+    import servo
+
+    clip = os.environ.get('SIM_CLIP')  # Video file to replay, synthetic players when unset
+    fps = float(os.environ.get('SIM_FPS', '30'))
+    num_players = int(os.environ.get('SIM_PLAYERS', '4'))
+    motion = float(os.environ.get('SIM_MOTION', '0.3'))  # Chance that a player moves during a phase
+    seed = int(os.environ.get('SIM_SEED', '0'))
+
+    class SimulatedCamera(camera.Camera):
+        def __init__(self, *args, device=0, **kwargs):
+            super().__init__(*args, device=ClipSource(clip, fps, num_players=num_players, motion=motion, seed=seed), **kwargs)
+
+    class SimulatedServo(servo.Servo):
+        def __init__(self):
+            super().__init__(servo.PigpioStandIn())
+
+    camera.Camera = SimulatedCamera
+    servo.Servo = SimulatedServo
+    # The real audio module needs pygame and a sound card, so it is never imported
+    audio = types.ModuleType("audio")
+    audio.Audio = SimulatedAudio
+    sys.modules["audio"] = audio
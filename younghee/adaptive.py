@@ -0,0 +1,52 @@
+import logging
+import time
+
+# Set up basic configuration for logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    datefmt='%H:%M:%S')
+
+# Capture profiles from best to cheapest: (width, height, fps, JPEG quality)
+CAPTURE_PROFILES = [
+    (960, 540, 30, 90),
+    (960, 540, 30, 75),
+    (800, 450, 24, 70),
+    (640, 360, 20, 65),
+    (480, 270, 15, 60),
+]
+
+class AdaptiveController:
+    """Steps the camera's capture profile down while end-to-end latency is over budget and back up when there is headroom.
+    Latency samples are capture to send, and capture to backend acknowledgement, in seconds. Each signal has its own
+    moving average, acks only come every few frames and would be drowned out by the per-frame send samples"""
+
+    def __init__(self, camera, latency_budget=0.25, smoothing=0.2, step_down_after=0.5, step_up_after=3.0):
+        self.camera = camera
+        self.latency_budget = latency_budget
+        self.smoothing = smoothing
+        self.step_down_after = step_down_after  # Seconds between steps, so each step can take effect first
+        self.step_up_after = step_up_after
+        self.level = 0
+        self.averages = {}  # Signal name -> exponentially weighted moving average
+        self.latency = None  # The larger of the averages, compared with the budget
+        self.last_change = time.monotonic()
+        self.camera.set_profile(*CAPTURE_PROFILES[self.level])
+
+    def observe(self, latency, signal="send"):
+        average = self.averages.get(signal)
+        self.averages[signal] = latency if average is None else average + self.smoothing * (latency - average)
+        self.latency = max(self.averages.values())
+
+        now = time.monotonic()
+        since_change = now - self.last_change
+        if self.latency > self.latency_budget and since_change > self.step_down_after and self.level < len(CAPTURE_PROFILES) - 1:
+            self._set_level(self.level + 1, now)
+        elif self.latency < self.latency_budget / 2 and since_change > self.step_up_after and self.level > 0:
+            self._set_level(self.level - 1, now)
+
+    def _set_level(self, level, now):
+        self.level = level
+        self.last_change = now
+        width, height, fps, quality = CAPTURE_PROFILES[level]
+        logging.info(f"Latency {self.latency * 1000:.0f} ms, capture profile {width}x{height} at {fps} fps, JPEG quality {quality}")
+        self.camera.set_profile(width, height, fps, quality)
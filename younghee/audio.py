@@ -1,3 +1,5 @@
+import asyncio
+import os
 import pygame
 import logging
 
@@ -6,18 +8,84 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     datefmt='%H:%M:%S')
 
+def _finish(future):
+    if not future.done():
+        future.set_result(None)
+
 class Audio:
-    def __init__(self):
+    """Plays clips decoded once at startup. Awaitable playback completes on a loop timer set to the
+    clip's length, so waiting for a clip never blocks the event loop"""
+
+    def __init__(self, audio_dir="audio"):
+        self.sounds = {}
+        self.announcement_channel = None
+        self.announcements = None  # Queue of (file_paths, future), created on first announce
+        self.announcer_task = None
+
         try:
             pygame.mixer.init()
-            logging.info("Audio player initialized")
+            # Keep one channel for announcements so sequences are never cut off by other clips
+            pygame.mixer.set_reserved(1)
+            self.announcement_channel = pygame.mixer.Channel(0)
+
+            for file_name in sorted(os.listdir(audio_dir)):
+                if file_name.endswith(".wav"):
+                    file_path = os.path.join(audio_dir, file_name)
+                    self.sounds[file_path] = pygame.mixer.Sound(file_path)
+            logging.info(f"Audio player initialized, {len(self.sounds)} clips loaded")
         except Exception as e:
             logging.error(f"Error initializing audio player: {e}")
 
+    def get_sound(self, file_path):
+        file_path = os.path.normpath(file_path)
+        sound = self.sounds.get(file_path)
+        if sound is None:
+            # Not in the preloaded directory, decode it once and keep it
+            sound = self.sounds[file_path] = pygame.mixer.Sound(file_path)
+        return sound
+
+    def _start(self, sound, channel=None):
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+        if channel is not None:
+            channel.play(sound)
+        else:
+            sound.play()
+        loop.call_later(sound.get_length(), _finish, finished)
+        return finished
+
+    async def play(self, file_path):
+        """Play a clip and wait for it to finish without blocking the event loop"""
+        try:
+            await self._start(self.get_sound(file_path))
+        except Exception as e:
+            logging.error(f"Error playing audio: {e}")
+
+    def announce(self, file_paths):
+        """Queue clips to play back to back on the announcement channel, returns a future for the whole sequence"""
+        loop = asyncio.get_running_loop()
+        if self.announcer_task is None:
+            self.announcements = asyncio.Queue()
+            self.announcer_task = loop.create_task(self._announcer())
+
+        done = loop.create_future()
+        self.announcements.put_nowait((file_paths, done))
+        return done
+
+    async def _announcer(self):
+        while True:
+            file_paths, done = await self.announcements.get()
+            for file_path in file_paths:
+                try:
+                    await self._start(self.get_sound(file_path), self.announcement_channel)
+                except Exception as e:
+                    logging.error(f"Error playing announcement: {e}")
+            _finish(done)
+
     def play_audio(self, file_path):
+        # Blocking playback, for scripts that don't run an event loop
         try:
-            # Don't fade in or out, just play the sound
-            sound = pygame.mixer.Sound(file_path)
+            sound = self.get_sound(file_path)
             sound.play()
             pygame.time.wait(int(sound.get_length() * 1000))  # Wait for the sound to finish
         except Exception as e:
@@ -25,8 +93,6 @@ class Audio:
 
     def play_audio_without_wait(self, file_path):
         try:
-            sound = pygame.mixer.Sound(file_path)
-            sound.play()
+            self.get_sound(file_path).play()
         except Exception as e:
             logging.error(f"Error playing audio: {e}")
-
@@ -0,0 +1,121 @@
+import argparse
+import json
+import time
+import cv2
+import numpy as np
+
+# Capture path benchmark: decode and re-encode every frame, versus forwarding the camera's own MJPEG.
+#   python benchmark.py --mjpeg recording.mjpeg
+#   python benchmark.py --device 0 --frames 300
+# Record a stream from the camera without re-encoding it with:
+#   ffmpeg -f v4l2 -input_format mjpeg -video_size 960x540 -i /dev/video0 -c copy -t 10 recording.mjpeg
+
+def mjpeg_frames(path, max_frames=None):
+    """Split a raw MJPEG stream, which is JPEG images back to back, into frames"""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    frames = []
+    start = data.find(b"\xff\xd8")
+    while start != -1 and (max_frames is None or len(frames) < max_frames):
+        end = data.find(b"\xff\xd9", start)
+        if end == -1:
+            break
+        frames.append(np.frombuffer(data, dtype=np.uint8, count=end + 2 - start, offset=start))
+        start = data.find(b"\xff\xd8", end + 2)
+    return frames
+
+def measure(name, num_frames, step):
+    # CPU time is process time, so it counts every thread OpenCV or libjpeg use
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    total_bytes = 0
+    for index in range(num_frames):
+        total_bytes += step(index)
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    return {
+        "path": name,
+        "frames": num_frames,
+        "fps": num_frames / wall if wall else 0.0,
+        "cpu_ms_per_frame": cpu / num_frames * 1000,
+        "cpu_percent": cpu / wall * 100 if wall else 0.0,
+        "mean_frame_kb": total_bytes / num_frames / 1024,
+    }
+
+def run_recorded(frames, quality):
+    """Replay recorded MJPEG frames as fast as each path allows"""
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+    def decode_reencode(index):
+        # What VideoCapture.read() and Camera.encode_frame do for every frame
+        frame = cv2.imdecode(frames[index], cv2.IMREAD_COLOR)
+        _, buffer = cv2.imencode(".jpg", frame, params)
+        return buffer.size
+
+    def passthrough(index):
+        return frames[index].size
+
+    def passthrough_filtered(index):
+        # Passthrough with the edge motion filter, which decodes a quarter size thumbnail
+        cv2.imdecode(frames[index], cv2.IMREAD_REDUCED_COLOR_4)
+        return frames[index].size
+
+    return [measure(name, len(frames), step) for name, step in
+            (("decode_reencode", decode_reencode), ("passthrough", passthrough), ("passthrough_filtered", passthrough_filtered))]
+
+def run_device(device, num_frames, quality, width=960, height=540):
+    """Capture from a live camera, so fps is what the camera and CPU together achieve"""
+    camera = cv2.VideoCapture(device, cv2.CAP_V4L2)
+    if not camera.isOpened():
+        raise SystemExit(f"Failed to open camera: {device}")
+    camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+    camera.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    camera.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    camera.set(cv2.CAP_PROP_FPS, 30)
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+    def decode_reencode(index):
+        _, frame = camera.read()
+        _, buffer = cv2.imencode(".jpg", frame, params)
+        return buffer.size
+
+    def passthrough(index):
+        _, data = camera.read()
+        return data.size
+
+    reports = []
+    camera.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+    reports.append(measure("decode_reencode", num_frames, decode_reencode))
+    if camera.set(cv2.CAP_PROP_CONVERT_RGB, 0):
+        reports.append(measure("passthrough", num_frames, passthrough))
+    else:
+        print("The camera backend does not support raw MJPEG frames, only the decode path was measured")
+    camera.release()
+    return reports
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the decode and re-encode capture path with MJPEG passthrough")
+    parser.add_argument("--mjpeg", help="Recorded raw MJPEG stream to replay")
+    parser.add_argument("--device", help="Camera index or device path to capture from instead")
+    parser.add_argument("--frames", type=int, default=300, help="Number of frames per path")
+    parser.add_argument("--quality", type=int, default=95, help="JPEG quality of the re-encode path")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    if args.device is not None:
+        device = int(args.device) if args.device.isdigit() else args.device
+        reports = run_device(device, args.frames, args.quality)
+    elif args.mjpeg:
+        frames = mjpeg_frames(args.mjpeg, args.frames)
+        if not frames:
+            raise SystemExit(f"No JPEG frames found in {args.mjpeg}")
+        reports = run_recorded(frames, args.quality)
+    else:
+        raise SystemExit("Pass --mjpeg or --device")
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print(f"{'path':<22}{'frames':>8}{'fps':>10}{'CPU ms/frame':>14}{'CPU %':>8}{'frame KB':>10}")
+        for report in reports:
+            print(f"{report['path']:<22}{report['frames']:>8}{report['fps']:>10.1f}{report['cpu_ms_per_frame']:>14.2f}"
+                  f"{report['cpu_percent']:>8.1f}{report['mean_frame_kb']:>10.1f}")
@@ -1,26 +1,99 @@
+import asyncio
 import base64
 import cv2
 import logging
+import os
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Repository root, for the shared package
+from shared.edgefilter import EdgeFilter
 
 # Set up basic configuration for logging
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     datefmt='%H:%M:%S')
 
+# An encoded frame produced by the capture worker, encoded_at is a time.monotonic() value.
+# Lane crops carry the lane's player ID and the crop's x offset, a full frame has lane 0
+Frame = namedtuple("Frame", ["seq", "timestamp", "width", "height", "data", "encoded_at", "lane", "x_offset"], defaults=(0, 0))
+
 class Camera:
-    def __init__(self):
+    def __init__(self, queue_size=8, motion_filter=False, filter_size=(160, 90), filter_threshold=15,
+                 filter_min_pixels=10, mjpeg_passthrough=False,
+                 raw_frames=False, device=0):
+        # Bounded ring of encoded frames, the oldest frame is dropped when the consumer falls behind
+        self.queue_size = queue_size
+        self.frames = deque(maxlen=queue_size)
+        self.frames_lock = threading.Lock()
+        self.frames_dropped = 0  # Dropped during the current capture window
+        self.frames_dropped_total = 0
+        self.frame_seq = 0
+        self.frame_available = None
+        self.loop = None
+        self.capturing = threading.Event()
+        self.running = False
+        self.capture_thread = None
+        self.frame_width = 960
+        self.frame_height = 540
+        # Output profile, frames are downscaled and thinned in the worker so the sensor never has to be reconfigured
+        self.output_size = (self.frame_width, self.frame_height)
+        self.output_fps = 30
+        self.jpeg_params = [cv2.IMWRITE_JPEG_QUALITY, 95]
+        self.last_output_timestamp = 0
+        self.lanes = None  # [(player_id, x_start, x_end)] to send lane crops instead of the full frame
+        self.raw_frames = raw_frames  # Queue BGR pixels instead of JPEG, for the shared memory transport
+
+        # Optional edge pre-filter: frames that barely differ from the backend's reference frame are not sent.
+        # The defaults are more sensitive than the backend's MotionDetector (threshold 30, min_area 750 at 960x540)
+        self.motion_filter = motion_filter
+        self.edge_filter = EdgeFilter(filter_size, filter_threshold, filter_min_pixels)
+        self.frames_filtered_total = 0
+
+        # MJPEG passthrough: the sensor's own JPEG is forwarded as-is when no pixels need to change
+        self.passthrough = False
+        self.sensor_size = self.output_size
+
         try:
-            self.camera = cv2.VideoCapture(0)  # Change 0 to the appropriate index or device path
+            # device is a camera index, a device path such as /dev/video2, or an already opened capture
+            self.device = device
+            if hasattr(device, "read"):
+                self.camera = device
+            else:
+                self.camera = cv2.VideoCapture(device, cv2.CAP_V4L2) if mjpeg_passthrough else cv2.VideoCapture(device)
             if not self.camera.isOpened():
-                logging.error("Failed to open camera.")
+                logging.error(f"Failed to open camera {device}.")
 
-            self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, 960)
-            self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 540)
+            if mjpeg_passthrough:
+                # The pixel format has to be chosen before the frame size
+                self.camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+            self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.frame_width)
+            self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.frame_height)
             self.camera.set(cv2.CAP_PROP_FPS, 30)
+            self.sensor_size = (int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            if mjpeg_passthrough:
+                self.passthrough = self._enable_passthrough()
             logging.info("Camera initialized")
         except Exception as e:
             logging.error(f"Error initializing camera: {e}")
 
+    def _enable_passthrough(self):
+        # Drivers accept settings they then ignore, so check that a real frame comes back as undecoded JPEG
+        try:
+            if int(self.camera.get(cv2.CAP_PROP_FOURCC)) == cv2.VideoWriter_fourcc(*"MJPG") and self.camera.set(cv2.CAP_PROP_CONVERT_RGB, 0):
+                ret, data = self.camera.read()
+                # Undecoded frames come back as a single row of bytes starting with the JPEG start-of-image marker
+                if ret and data is not None and data.size == max(data.shape) and data.reshape(-1)[:2].tobytes() == b"\xff\xd8":
+                    logging.info(f"MJPEG passthrough enabled at {self.sensor_size[0]}x{self.sensor_size[1]}")
+                    return True
+            self.camera.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+        except Exception as e:
+            logging.error(f"Error enabling MJPEG passthrough: {e}")
+        logging.info("MJPEG passthrough not supported by the camera, decoding and re-encoding frames")
+        return False
+
     def capture_and_encode_image(self):
         try:
             logging.debug("Capturing image...")
@@ -28,6 +101,8 @@ class Camera:
             if not ret:
                 logging.error("Failed to capture image.")
                 return None
+            if self.passthrough:
+                return base64.b64encode(frame.reshape(-1)).decode("utf-8")
 
             # Convert the image to base64
             _, buffer = cv2.imencode(".jpg", frame)
@@ -37,8 +112,175 @@ class Camera:
             logging.error(f"Error capturing and encoding image: {e}")
             return None
 
+    def capture_frame(self):
+        """Capture a frame and return (timestamp, frame), in passthrough mode frame is a 1-D array of JPEG bytes"""
+        try:
+            ret, frame = self.camera.read()
+            timestamp = time.time()
+            if not ret:
+                logging.error("Failed to capture image.")
+                return None
+            return timestamp, frame
+        except Exception as e:
+            logging.error(f"Error capturing frame: {e}")
+            return None
+
+    def encode_frame(self, timestamp, frame):
+        """Return (timestamp, width, height, jpeg_bytes) without base64 encoding"""
+        try:
+            _, buffer = cv2.imencode(".jpg", frame, self.jpeg_params)
+            height, width = frame.shape[:2]
+            return timestamp, width, height, buffer
+        except Exception as e:
+            logging.error(f"Error encoding frame: {e}")
+            return None
+
+    def _output(self, timestamp, frame):
+        # Same shape as encode_frame's result, raw frames skip the encoder
+        if self.raw_frames:
+            height, width = frame.shape[:2]
+            return timestamp, width, height, frame
+        return self.encode_frame(timestamp, frame)
+
+    def capture_and_encode_frame(self):
+        captured = self.capture_frame()
+        if captured is None:
+            return None
+        timestamp, frame = captured
+        if self.passthrough:
+            return timestamp, *self.sensor_size, frame.reshape(-1)
+        return self.encode_frame(timestamp, frame)
+
+    def _passes_filter(self, frame):
+        if self.edge_filter.passes(frame, self.frame_seq):
+            return True
+        self.frames_filtered_total += 1
+        return False
+
+    def _publish(self, entries):
+        with self.frames_lock:
+            for entry in entries:
+                if len(self.frames) == self.frames.maxlen:
+                    self.frames_dropped += 1
+                    self.frames_dropped_total += 1
+                self.frames.append(entry)
+        self.loop.call_soon_threadsafe(self.frame_available.set)
+
+    def set_profile(self, width, height, fps, quality):
+        """Change the output resolution, frame rate and JPEG quality, takes effect from the next captured frame"""
+        self.output_size = (width, height)
+        self.output_fps = fps
+        self.jpeg_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+    def set_lanes(self, lanes):
+        """Send only these (player_id, x_start, x_end) crops of each frame, or the full frame when lanes is None"""
+        with self.frames_lock:
+            self.lanes = [tuple(lane) for lane in lanes] if lanes else None
+            # Each crop takes a queue slot, so the queue holds the same number of captured frames
+            self.frames = deque(self.frames, maxlen=self.queue_size * max(1, len(self.lanes or ())))
+
+    def start_capture(self):
+        """Start filling the frame queue from the capture worker, must be called from the event loop"""
+        self.loop = asyncio.get_running_loop()
+        self.frame_available = asyncio.Event()
+        with self.frames_lock:
+            self.frames.clear()
+            self.frames_dropped = 0
+        # The first frame of every window is forwarded so the backend starts from a fresh reference
+        self.edge_filter.reset()
+        self.capturing.set()
+
+        if self.capture_thread is None:
+            self.running = True
+            self.capture_thread = threading.Thread(target=self._capture_worker, name="camera-capture", daemon=True)
+            self.capture_thread.start()
+            logging.info("Camera capture worker started")
+
+    def stop_capture(self):
+        self.capturing.clear()
+
+    async def next_frame(self, timeout=None):
+        """Wait for the oldest queued frame, returns None if no frame arrives within the timeout"""
+        # Always give up the loop once per frame. A send under the write buffer limit doesn't yield either, so a sender
+        # that keeps up with the camera would otherwise hold the loop for the whole capture window
+        await asyncio.sleep(0)
+        while True:
+            with self.frames_lock:
+                if self.frames:
+                    return self.frames.popleft()
+                self.frame_available.clear()
+
+            try:
+                await asyncio.wait_for(self.frame_available.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+    def _capture_worker(self):
+        while self.running:
+            if not self.capturing.is_set():
+                # Keep draining the sensor so capture resumes with fresh frames rather than stale buffered ones
+                if not self.camera.grab():
+                    time.sleep(0.01)
+                continue
+
+            captured = self.capture_frame()
+            if captured is None:
+                time.sleep(0.01)
+                continue
+
+            # Sequence numbers count every captured frame, so filtered frames show up as gaps
+            self.frame_seq += 1
+            timestamp, frame = captured
+
+            # Thin the frame rate to the output profile, with a little slack for sensor timing jitter
+            if timestamp - self.last_output_timestamp < 0.9 / self.output_fps:
+                continue
+            self.last_output_timestamp = timestamp
+
+            if self.passthrough:
+                jpeg = frame.reshape(-1)
+                if self.output_size == self.sensor_size and not self.lanes and not self.raw_frames:
+                    # Nothing to resize or crop, forward the sensor's JPEG. The motion filter only needs
+                    # a thumbnail, which libjpeg decodes at a quarter of the size for a fraction of the cost
+                    if self.motion_filter and not self._passes_filter(cv2.imdecode(jpeg, cv2.IMREAD_REDUCED_COLOR_4)):
+                        continue
+                    self._publish([Frame(self.frame_seq, timestamp, *self.sensor_size, jpeg, time.monotonic())])
+                    continue
+                frame = cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+                if frame is None:
+                    logging.error("Failed to decode camera frame.")
+                    continue
+
+            scale = 1
+            if (frame.shape[1], frame.shape[0]) != self.output_size:
+                scale = self.output_size[0] / frame.shape[1]
+                frame = cv2.resize(frame, self.output_size, interpolation=cv2.INTER_AREA)
+
+            if self.motion_filter and not self._passes_filter(frame):
+                continue
+
+            lanes = self.lanes
+            if lanes:
+                # Crops are views into the frame, only the lanes still in play are encoded.
+                # Lane ranges are in sensor pixels and follow the output scale
+                entries = []
+                for player_id, x_start, x_end in lanes:
+                    x_start, x_end = int(x_start * scale), int(x_end * scale)
+                    encoded = self._output(timestamp, frame[:, x_start:x_end])
+                    if encoded is not None:
+                        entries.append(Frame(self.frame_seq, *encoded, time.monotonic(), player_id, x_start))
+            else:
+                encoded = self._output(timestamp, frame)
+                entries = [Frame(self.frame_seq, *encoded, time.monotonic())] if encoded is not None else []
+
+            if entries:
+                self._publish(entries)
+
     async def close(self):
         try:
+            self.running = False
+            if self.capture_thread is not None:
+                await asyncio.to_thread(self.capture_thread.join, 1)
             self.camera.release()
             logging.info("Camera released.")
         except Exception as e:
@@ -7,9 +7,18 @@ import os
 import logging
 import random
 import base64
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Repository root, for the shared package
 from audio import Audio
 from servo import Servo
 from camera import Camera
+from adaptive import AdaptiveController
+from shared.protocol import pack_frame
+from shared.framering import FrameRing
+from shared.players import PlayerRegistry
+from shared.lanes import load_layout, equal_lanes, lanes_by_camera
+from shared.tracing import Tracer
+from shared.metrics import Counter, Gauge, Histogram, LATENCY_BUCKETS, serve_metrics, monitor_event_loop_lag
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -26,7 +35,21 @@ BACKEND_PORT = os.environ['BACKEND_PORT']
 MOBILE_APP_PORT = os.environ['MOBILE_APP_PORT']
 MAX_GAME_TIME = 60  # 3 minutes
 COUNTDOWN_TIME = 5  # 5 seconds
-MAX_PLAYERS = 4
+MAX_PLAYERS = int(os.environ.get('MAX_PLAYERS', '32'))  # Keep at or below the backend's MAX_NUM_PLAYERS
+LANES_FILE = os.environ.get('LANES_FILE')  # Lane layout JSON with the cameras to open, one camera split equally between players when unset
+BINARY_FRAMES = os.environ.get('BINARY_FRAMES', '1') == '1'  # Send video frames as binary messages instead of base64 JSON
+TRACE_FILE = os.environ.get('TRACE_FILE')  # JSONL file for latency trace spans, tracing is off when unset
+LANE_CROPS = BINARY_FRAMES and os.environ.get('LANE_CROPS', '0') == '1'  # Send only the lanes of players still in play
+ADAPTIVE_QUALITY = os.environ.get('ADAPTIVE_QUALITY', '0') == '1'  # Trade capture quality for latency under backpressure
+LATENCY_BUDGET_MS = int(os.environ.get('LATENCY_BUDGET_MS', '250'))  # Capture to backend acknowledgement budget
+EDGE_MOTION_FILTER = os.environ.get('EDGE_MOTION_FILTER', '0') == '1'  # Only send frames with motion, plus the backend's reference frames
+MJPEG_PASSTHROUGH = os.environ.get('MJPEG_PASSTHROUGH', '0') == '1'  # Forward the camera's own JPEG frames without re-encoding
+SHARED_MEMORY_FRAMES = os.environ.get('SHARED_MEMORY_FRAMES', '0') == '1'  # Raw frames through shared memory, backend on this host only
+SHARED_MEMORY_NAME = os.environ.get('SHARED_MEMORY_NAME', 'squid-frames')
+MOBILE_APP_MAX_MESSAGE = int(os.environ.get('MOBILE_APP_MAX_MESSAGE', str(64 * 2 ** 20)))  # players_info carries every headshot, megabytes each
+PLAYER_IMAGES_DIR = os.environ.get('PLAYER_IMAGES_DIR')  # Also save registration photos here, they are only kept in memory when unset
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '8767'))
 
 # Global variables
 game_in_progress = False
@@ -35,17 +58,51 @@ mobile_app_socket = None
 backend_socket = None
 eliminated_players_event = asyncio.Event()  # Event to signal when eliminated players are received
 all_eliminated_players = set()  # List to track eliminated players
-
-# Initialize the audio player, servo controller, and camera
+background_tasks = set()  # Keeps references to fire-and-forget tasks until they finish
+current_round = None  # ID of the current red light, shared with the backend for tracing
+player_registration = None  # Task loading the current game's player photos and forwarding them to the backend
+
+# Lane layout, a layout file names the cameras and which columns of which camera each player stands in
+if LANES_FILE:
+    layout_width, camera_devices, lane_layout = load_layout(LANES_FILE)
+    logging.info(f"Loaded lane layout for {len(lane_layout)} players on {len(camera_devices)} cameras from {LANES_FILE}")
+else:
+    layout_width, camera_devices, lane_layout = 960, [0], None
+
+# Initialize the audio player, servo controller, and cameras
 audio = Audio()   # Initialize the audio player
 servo = Servo()  # Initialize the servo controller
-camera = Camera()  # Initialize the camera
+cameras = [Camera(motion_filter=EDGE_MOTION_FILTER, mjpeg_passthrough=MJPEG_PASSTHROUGH, raw_frames=SHARED_MEMORY_FRAMES, device=device)
+           for device in camera_devices]  # Initialize the cameras, frames carry their index in this list
+camera = cameras[0]
+tracer = Tracer(TRACE_FILE, "doll")
+player_registry = PlayerRegistry(persist_dir=PLAYER_IMAGES_DIR)
+# Sized for a full frame at the camera's capture resolution, lane crops are smaller
+frame_ring = FrameRing(SHARED_MEMORY_NAME, create=True, slot_size=camera.frame_width * camera.frame_height * 3) if SHARED_MEMORY_FRAMES else None
+adaptive_controllers = [AdaptiveController(camera, LATENCY_BUDGET_MS / 1000) for camera in cameras] if ADAPTIVE_QUALITY else None
+frames_in_flight = {}  # (camera index, sequence number) -> encode time of frames sent but not yet acknowledged by the backend
+
+# Metrics, served on METRICS_PORT. Camera totals are read at scrape time so the capture workers pay nothing
+FRAMES_CAPTURED = Counter("squid_frames_captured_total", "Frames captured and encoded by the camera workers", function=lambda: sum(camera.frame_seq for camera in cameras))
+FRAMES_DROPPED = Counter("squid_frames_dropped_total", "Frames dropped from the capture queues because sending fell behind",
+                         function=lambda: sum(camera.frames_dropped_total for camera in cameras))
+FRAMES_FILTERED = Counter("squid_frames_filtered_total", "Frames not sent because the edge motion filter saw no motion",
+                          function=lambda: sum(camera.frames_filtered_total for camera in cameras))
+FRAMES_SENT = Counter("squid_frames_sent_total", "Frames sent to the backend")
+BYTES_SENT = Counter("squid_frame_bytes_sent_total", "Frame payload bytes sent to the backend")
+CAPTURE_QUEUE_DEPTH = Gauge("squid_capture_queue_depth", "Encoded frames waiting to be sent", function=lambda: sum(len(camera.frames) for camera in cameras))
+SEND_BUFFER_BYTES = Gauge("squid_backend_send_buffer_bytes", "Bytes waiting in the backend WebSocket write buffer",
+                          function=lambda: backend_socket.transport.get_write_buffer_size() if backend_socket else 0)
+FRAME_SEND_SECONDS = Histogram("squid_frame_send_seconds", "Time to hand a frame to the backend WebSocket", LATENCY_BUCKETS)
+FRAME_JITTER_SECONDS = Histogram("squid_frame_jitter_seconds", "Change in capture interval between consecutive frames", LATENCY_BUCKETS)
+ELIMINATIONS_PER_ROUND = Histogram("squid_eliminations_per_round", "Players eliminated per red light", range(MAX_PLAYERS + 1))
+EVENT_LOOP_LAG_SECONDS = Histogram("squid_event_loop_lag_seconds", "Delay of the event loop in waking a sleeping task", LATENCY_BUCKETS)
 
 async def mobile_app_handler(websocket):
     logging.info(f"Mobile app connected: {websocket.remote_address}")
     await websocket.send(json.dumps({"type": "connected", "data": str("True")}))
 
-    global mobile_app_socket, backend_socket, game_in_progress, num_players
+    global mobile_app_socket, backend_socket, game_in_progress, num_players, player_registration
     mobile_app_socket = websocket
 
     async for message in websocket:
@@ -53,25 +110,75 @@ async def mobile_app_handler(websocket):
         if packet.get("type") == "players_info":
             if not game_in_progress:
                 game_in_progress = True  # Set the game to in-progress when player info is received
-                num_players = len(packet.get("data", list()))
-                # Display the player images as a list
-                for player_id, player_image in enumerate(packet.get("data", list())):
-                    player_id += 1 # Player IDs are 1-indexed
-                    with open(f"player_images/{player_id}.jpg", "wb") as f:
-                        f.write(base64.b64decode(player_image))
-
+                player_images = packet.get("data", list())
+                lane_count = len(lane_layout) if lane_layout else MAX_PLAYERS
+                if len(player_images) > lane_count:
+                    # Players without a lane can't be watched, they are left out of the game rather than never eliminated
+                    logging.warning(f"{len(player_images)} players registered, only the first {lane_count} have a lane and can play")
+                    player_images = player_images[:lane_count]
+                num_players = len(player_images)
                 logging.info(f"Received players info, total players: {num_players}")
                 logging.info(f"Setting game in progress to: {game_in_progress}")
 
-                # Echo the players info to the backend client
-                if backend_socket:
-                    await backend_socket.send(message)
-                    logging.info(f"Echoed players info to backend")
+                # Photos are loaded in the background, the game loop waits for them before the first red light
+                player_registration = asyncio.create_task(register_players(player_images))
             else:
                 logging.warning("Game is already in progress, ignoring players info")
         else:
             logging.warning(f"Unknown message type from mobile app: {packet}")
 
+async def register_players(player_images):
+    # Player IDs are 1-indexed, players that registered without a photo are skipped
+    try:
+        with tracer.span("register_players", None, players=len(player_images)):
+            loaded = await player_registry.register({player_id: image for player_id, image in enumerate(player_images, start=1) if image})
+        logging.info(f"Loaded images for {loaded} of {len(player_images)} players")
+
+        # The backend gets downscaled copies, a fraction of the size of the phone's photos, one player per message
+        # so each stays under the connection's message size limit. players_info tells it the last one has arrived
+        if backend_socket:
+            for player_id, thumbnail in enumerate(player_registry.encoded_thumbnails(len(player_images)), start=1):
+                if thumbnail:
+                    await backend_socket.send(json.dumps({"type": "player_thumbnail", "player_id": player_id, "data": thumbnail}))
+            await backend_socket.send(json.dumps({"type": "players_info", "num_players": len(player_images)}))
+            logging.info("Forwarded player thumbnails to backend")
+    except Exception as e:
+        logging.error(f"Error registering players: {e}")
+
+async def send_eliminated_players_to_mobile_app():
+    # The mobile app expects every eliminated player so far. players is a comma separated string of player IDs,
+    # apps that predate it read data one character per player, so data only carries the IDs under 10
+    if mobile_app_socket:
+        eliminated = sorted(all_eliminated_players)
+        await mobile_app_socket.send(json.dumps({
+            "type": "eliminated_players",
+            "data": "".join(str(player_id) for player_id in eliminated if player_id < 10),
+            "players": ",".join(map(str, eliminated))
+        }))
+        logging.info("Echoed eliminated players to mobile app")
+
+def player_lanes():
+    # Every registered player's lane, without a layout file the frame width is split equally, matching MotionDetector.set_regions
+    if lane_layout is None:
+        return equal_lanes(num_players, layout_width)
+    return {player_id: lane for player_id, lane in lane_layout.items() if player_id <= num_players}
+
+def active_lanes():
+    # Crops of the lanes still in play, scaled from layout pixels to the camera's capture width. Single camera only
+    scale = camera.frame_width / layout_width
+    return [[player_id, int(x_start * scale), int(x_end * scale)]
+            for player_id, x_start, x_end in lanes_by_camera(player_lanes()).get(0, []) if player_id not in all_eliminated_players]
+
+async def announce_eliminations(eliminated_players):
+    with tracer.span("announce", current_round, players=eliminated_players):
+        # Recorded player numbers only go so far, beyond them the elimination sound plays on its own
+        clips = [f"audio/player_{player_id}.wav" for player_id in eliminated_players]
+        await audio.announce(["audio/eliminated.wav"] + [clip for clip in clips if os.path.exists(clip)])
+
+    # Set the event to signal the game loop to proceed
+    eliminated_players_event.set()
+    logging.info("Set eliminated players event")
+
 async def backend_handler(websocket):
     logging.info(f"Backend connected: {websocket.remote_address}")
 
@@ -80,32 +187,78 @@ async def backend_handler(websocket):
 
     async for message in websocket:
         packet = json.loads(message)
-        if packet.get("type") == "eliminated_players":
+        if packet.get("type") == "frame_ack":
+            # The backend acknowledges every few processed frames, the lag drives the adaptive controller
+            data = packet.get("data", dict())
+            camera_index = data.get("camera", 0)
+            encoded_at = frames_in_flight.pop((camera_index, data.get("seq")), None)
+            if encoded_at is not None and adaptive_controllers:
+                adaptive_controllers[camera_index].observe(time.monotonic() - encoded_at, "ack")
+
+        elif packet.get("type") == "player_eliminated":
+            # Streamed elimination, forward it to the mobile app straight away
+            player_id = packet.get("data", dict()).get("player_id")
+            if player_id is not None and player_id not in all_eliminated_players:
+                all_eliminated_players.add(player_id)
+                logging.info(f"Received player eliminated: {player_id} (frame {packet['data'].get('seq')})")
+                tracer.mark("elimination_received", packet.get("round"), player_id=player_id, seq=packet["data"].get("seq"))
+                with tracer.span("forward_to_mobile_app", packet.get("round"), player_id=player_id):
+                    await send_eliminated_players_to_mobile_app()
+
+        elif packet.get("type") == "eliminated_players":
+            # End of window summary, players already streamed to the mobile app are not sent again
             eliminated_players = packet.get("data", list())
+            newly_eliminated = [player_id for player_id in eliminated_players if player_id not in all_eliminated_players]
             all_eliminated_players.update(eliminated_players)
             logging.info(f"Received eliminated players: {eliminated_players}")
             logging.info(f"Total eliminated players: {all_eliminated_players}")
 
-            # Echo eliminated players data to the mobile app
-            if mobile_app_socket:
-                await mobile_app_socket.send(json.dumps({
-                    "type": "eliminated_players",
-                    "data": "".join(map(str, all_eliminated_players))
-                }))
-                logging.info("Echoed eliminated players to mobile app")
+            if newly_eliminated:
+                with tracer.span("forward_to_mobile_app", packet.get("round"), players=newly_eliminated):
+                    await send_eliminated_players_to_mobile_app()
 
-            # Play the elimination audio
+            # Announce in the background so backend messages keep flowing, the game loop proceeds once it is done
             logging.info("Playing elimination audio...")
-            audio.play_audio("audio/eliminated.wav")
-            for player_id in eliminated_players:
-                audio.play_audio(f"audio/player_{player_id}.wav")
-
-            # Set the event to signal the game loop to proceed
-            eliminated_players_event.set()
-            logging.info("Set eliminated players event")
+            task = asyncio.create_task(announce_eliminations(eliminated_players))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+
+async def stream_frames(camera_index, camera, time_end):
+    # Sends one camera's frames to the backend until time_end, the cameras in play each run one of these
+    previous_timestamp, previous_interval = None, None
+    while (remaining := time_end - time.time()) > 0:
+        frame = await camera.next_frame(timeout=remaining)
+        if frame is None or not backend_socket:
+            continue
+
+        send_start = time.monotonic()
+        tracer.record("frame_queue", current_round, frame.encoded_at, send_start, seq=frame.seq, camera=camera_index)
+        if frame_ring:
+            # Published in place, the backend polls the ring while the stream is on
+            if not frame_ring.write(frame.seq, frame.timestamp, frame.data, frame.lane, frame.x_offset, camera_index):
+                logging.error(f"Frame {frame.seq} ({frame.width}x{frame.height}) does not fit the shared memory ring")
+        elif BINARY_FRAMES:
+            await backend_socket.send(pack_frame(frame.seq, frame.timestamp, frame.width, frame.height, frame.data, frame.lane, frame.x_offset, camera_index))
+        else:
+            await backend_socket.send(json.dumps({"type": "video_frame", "data": base64.b64encode(frame.data).decode("utf-8")}))
+        send_end = time.monotonic()
+        frames_in_flight[(camera_index, frame.seq)] = frame.encoded_at
+        if adaptive_controllers:
+            adaptive_controllers[camera_index].observe(send_end - frame.encoded_at, "send")
+        tracer.record("send", current_round, send_start, send_end, seq=frame.seq, camera=camera_index, size=frame.data.nbytes)
+
+        FRAMES_SENT.inc()
+        BYTES_SENT.inc(frame.data.nbytes)
+        FRAME_SEND_SECONDS.observe(send_end - send_start)
+        if previous_timestamp is not None:
+            interval = frame.timestamp - previous_timestamp
+            if previous_interval is not None:
+                FRAME_JITTER_SECONDS.observe(abs(interval - previous_interval))
+            previous_interval = interval
+        previous_timestamp = frame.timestamp
 
 async def main_game_loop():
-    global backend_socket, mobile_app_socket, game_in_progress, num_players, eliminated_players_event, all_eliminated_players
+    global backend_socket, mobile_app_socket, game_in_progress, num_players, eliminated_players_event, all_eliminated_players, current_round
 
     try:
         while True:
@@ -120,42 +273,68 @@ async def main_game_loop():
                 await asyncio.sleep(COUNTDOWN_TIME - 2)  # Wait for the mobile app to receive the game end time
 
                 logging.info("Playing game start audio...")
-                audio.play_audio("audio/game_start.wav")
+                await audio.play("audio/game_start.wav")
+                if player_registration:
+                    await player_registration  # The backend needs the players before the first red light
 
+                round_number = 0
                 while True:
-                    # 2. Green light and random wait time
-                    servo.turn_forwards()
-                    audio.play_audio("audio/green_light.wav")
+                    round_number += 1
+                    current_round = f"{int(start_time)}-{round_number}"
+                    eliminated_before_round = len(all_eliminated_players)
+
+                    # 2. Green light and random wait time, the head turns while the audio plays
+                    await asyncio.gather(servo.move_forwards(), audio.play("audio/green_light.wav"))
                     wait_time = random.uniform(1, 1.75)
                     logging.info(f"Waiting for {wait_time} seconds...")
                     await asyncio.sleep(wait_time)
 
-                    # 3. Red light, turn head around
-                    servo.turn_backwards()
-                    audio.play_audio(f"audio/red_light_2_padded.wav")
-
-                    # 4. Start capturing video for 10 seconds at 30 FPS
+                    # 3. Red light, turn head around while the audio plays
+                    red_light_start = time.monotonic()
+                    head_turned = servo.move_backwards()
+                    head_turned.add_done_callback(lambda _, round_id=current_round, start=red_light_start: tracer.record("servo_turn", round_id, start, time.monotonic()))
+
+                    # 4. Start capturing video for 10 seconds at 30 FPS, the backend gets ready during the turn.
+                    # With lane crops the round's active-lane layout is sent along, the backend sets up one detector per lane.
+                    # Several cameras send full frames, each one's lanes are watched by its own backend worker
+                    layout = player_lanes()
+                    playing_cameras = [(index, cameras[index]) for index in sorted(lanes_by_camera(
+                        {player_id: lane for player_id, lane in layout.items() if player_id not in all_eliminated_players}))]
+                    lanes = active_lanes() if LANE_CROPS and len(cameras) == 1 else None
+                    camera.set_lanes(lanes)
                     if backend_socket:
                         logging.info("Sending start video stream command to backend")
-                        await backend_socket.send(json.dumps({"type": "start_video_stream", "data": bool(True)}))
+                        await backend_socket.send(json.dumps({"type": "start_video_stream", "data": bool(True), "round": current_round, "lanes": lanes,
+                                                              "layout": {player_id: list(lane) for player_id, lane in layout.items()},
+                                                              "layout_width": layout_width, "shm": frame_ring.name if frame_ring else None}))
+                    await asyncio.gather(head_turned, audio.play(f"audio/red_light_2_padded.wav"))
+                    tracer.record("red_light", current_round, red_light_start, time.monotonic())
 
                     logging.info("Capturing video and sending to backend...")
+                    capture_start = time.monotonic()
+                    for _, playing_camera in playing_cameras:
+                        playing_camera.start_capture()
+                    frames_in_flight.clear()
                     time_end = time.time() + 3  # Capture for 5 seconds
-                    while time.time() < time_end:
-                        encoded_buffer = camera.capture_and_encode_image()
-                        if encoded_buffer is not None:
-                            if backend_socket:
-                                await backend_socket.send(json.dumps({"type": "video_frame", "data": str(encoded_buffer)}))
+                    await asyncio.gather(*(stream_frames(index, playing_camera, time_end) for index, playing_camera in playing_cameras))
+                    for _, playing_camera in playing_cameras:
+                        playing_camera.stop_capture()
+                    dropped = sum(playing_camera.frames_dropped for _, playing_camera in playing_cameras)
+                    tracer.record("capture_window", current_round, capture_start, time.monotonic(), dropped=dropped, cameras=len(playing_cameras))
+                    logging.info(f"Capture finished on {len(playing_cameras)} cameras, dropped {dropped} frames")
 
                     if backend_socket:
                         logging.info("Sending stop video stream command to backend")
-                        await backend_socket.send(json.dumps({"type": "stop_video_stream", "data": bool(True)}))
+                        await backend_socket.send(json.dumps({"type": "stop_video_stream", "data": bool(True), "round": current_round}))
 
                     # 5. Wait until the eliminated players are sent back to us before proceeding
                     logging.info("Waiting for eliminated players...")
-                    await eliminated_players_event.wait()
+                    with tracer.span("await_eliminations", current_round):
+                        await eliminated_players_event.wait()
                     logging.info("Eliminated players received")
                     eliminated_players_event.clear()
+                    tracer.finish_round(current_round)
+                    ELIMINATIONS_PER_ROUND.observe(len(all_eliminated_players) - eliminated_before_round)
 
                     # 6. Check for game end conditions (either no players left or max game time reached)
                     if len(all_eliminated_players) >= num_players or (time.time() - start_time) > MAX_GAME_TIME:
@@ -168,7 +347,7 @@ async def main_game_loop():
                             await mobile_app_socket.send(json.dumps({"type": "game_over", "data": str("True")}))
 
                         logging.info("Playing game end audio...")
-                        audio.play_audio("audio/game_end.wav")
+                        await audio.play("audio/game_end.wav")
                         game_in_progress = False
                         all_eliminated_players.clear()
                         break
@@ -179,7 +358,12 @@ async def main_game_loop():
     except Exception as e:
         logging.error(f"Error in main game loop: {e}")
     finally:
-        await camera.close()
+        for each_camera in cameras:
+            await each_camera.close()
+        if frame_ring:
+            frame_ring.close()
+        player_registry.close()
+        tracer.close()
 
 async def main():
     # Start WebSocket servers for mobile app and backend
@@ -187,8 +371,10 @@ async def main():
     logging.info(f"WebSocket server for backend client started on ws://{CURRENT_IP}:{BACKEND_PORT}")
 
     await asyncio.gather(
-        websockets.serve(mobile_app_handler, CURRENT_IP, MOBILE_APP_PORT),
+        websockets.serve(mobile_app_handler, CURRENT_IP, MOBILE_APP_PORT, max_size=MOBILE_APP_MAX_MESSAGE),
         websockets.serve(backend_handler, CURRENT_IP, BACKEND_PORT),
+        serve_metrics(METRICS_HOST, METRICS_PORT),
+        monitor_event_loop_lag(EVENT_LOOP_LAG_SECONDS),
         main_game_loop()
     )
 
@@ -1,32 +1,108 @@
-import pigpio
+import asyncio
 import time
 import logging
 
+# pigpio is only available on the Pi, elsewhere the stand-in below records commands instead
+try:
+    import pigpio
+except ImportError:
+    pigpio = None
+
 # Set up basic configuration for logging
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     datefmt='%H:%M:%S')
 
+# Calibrated pulse widths in microseconds
+FORWARDS_PULSEWIDTH = 600
+HALFWAY_PULSEWIDTH = 1500
+BACKWARDS_PULSEWIDTH = 2400
+SETTLE_TIME = 1  # Seconds for the head to finish turning before the PWM signal is released
+
+class PigpioStandIn:
+    """Stands in for pigpio.pi() on machines without a Pi, recording each pulse width with a monotonic timestamp"""
+    OUTPUT = 1
+
+    def __init__(self):
+        self.connected = True
+        self.commands = []
+
+    def set_mode(self, gpio, mode):
+        pass
+
+    def set_PWM_frequency(self, gpio, frequency):
+        pass
+
+    def set_servo_pulsewidth(self, gpio, pulsewidth):
+        self.commands.append((time.monotonic(), gpio, pulsewidth))
+
+    def stop(self):
+        self.connected = False
+
 class Servo:
     """Operates each of the servos to their calibrated open/close position"""
 
-    def __init__(self):
+    def __init__(self, pi=None):
+        self.pending_move = None  # (future, release handle) of the move still settling
         try:
-            self.pwm = pigpio.pi()
+            if pi is None:
+                pi = pigpio.pi() if pigpio is not None else PigpioStandIn()
+            self.pwm = pi
             self.servo = 18
 
-            self.pwm.set_mode(self.servo, pigpio.OUTPUT)
+            self.pwm.set_mode(self.servo, pigpio.OUTPUT if pigpio is not None else PigpioStandIn.OUTPUT)
             self.pwm.set_PWM_frequency(self.servo, 100)
             self.turn_backwards()
             logging.info("Servo initialized")
         except Exception as e:
             logging.error(f"Error initializing servo: {e}")
 
+    def move(self, pulsewidth, settle_time=SETTLE_TIME):
+        """Start turning the head and return a future that completes once the PWM signal has been released.
+        The release is scheduled on the event loop, so other work can run while the head turns"""
+        loop = asyncio.get_running_loop()
+        moved = loop.create_future()
+        try:
+            # A new move supersedes the previous one, its release must not cut this one short
+            if self.pending_move is not None:
+                previous, release_handle = self.pending_move
+                release_handle.cancel()
+                if not previous.done():
+                    previous.set_result(None)
+
+            self.pwm.set_servo_pulsewidth(self.servo, pulsewidth)
+            self.pending_move = (moved, loop.call_later(settle_time, self._release, moved))
+        except Exception as e:
+            logging.error(f"Error moving servo: {e}")
+            moved.set_result(None)
+        return moved
+
+    def _release(self, moved):
+        try:
+            self.pwm.set_servo_pulsewidth(self.servo, 0)
+        except Exception as e:
+            logging.error(f"Error releasing servo: {e}")
+        self.pending_move = None
+        if not moved.done():
+            moved.set_result(None)
+
+    def move_forwards(self):
+        logging.info("Turning servo forwards")
+        return self.move(FORWARDS_PULSEWIDTH)
+
+    def move_halfway(self):
+        logging.info("Turning servo halfway")
+        return self.move(HALFWAY_PULSEWIDTH)
+
+    def move_backwards(self):
+        logging.info("Turning servo backwards")
+        return self.move(BACKWARDS_PULSEWIDTH)
+
     def turn_forwards(self):
         try:
             logging.info("Turning servo forwards")
-            self.pwm.set_servo_pulsewidth(self.servo, 600)
-            time.sleep(1)
+            self.pwm.set_servo_pulsewidth(self.servo, FORWARDS_PULSEWIDTH)
+            time.sleep(SETTLE_TIME)
             self.pwm.set_servo_pulsewidth(self.servo, 0)
         except Exception as e:
             logging.error(f"Error turning servo forwards: {e}")
@@ -34,8 +110,8 @@ class Servo:
     def turn_halfway(self):
         try:
             logging.info("Turning servo halfway")
-            self.pwm.set_servo_pulsewidth(self.servo, 1500)
-            time.sleep(1)
+            self.pwm.set_servo_pulsewidth(self.servo, HALFWAY_PULSEWIDTH)
+            time.sleep(SETTLE_TIME)
             self.pwm.set_servo_pulsewidth(self.servo, 0)
         except Exception as e:
             logging.error(f"Error turning servo halfway: {e}")
@@ -43,8 +119,8 @@ class Servo:
     def turn_backwards(self):
         try:
             logging.info("Turning servo backwards")
-            self.pwm.set_servo_pulsewidth(self.servo, 2400)
-            time.sleep(1)
+            self.pwm.set_servo_pulsewidth(self.servo, BACKWARDS_PULSEWIDTH)
+            time.sleep(SETTLE_TIME)
             self.pwm.set_servo_pulsewidth(self.servo, 0)
         except Exception as e:
             logging.error(f"Error turning servo backwards: {e}")
@@ -52,13 +128,31 @@ class Servo:
     def stop(self):
         try:
             logging.info("Stopping servo")
+            if self.pending_move is not None:
+                self.pending_move[1].cancel()
+                self.pending_move = None
             self.pwm.set_servo_pulsewidth(self.servo, 0)
             self.pwm.stop()
         except Exception as e:
             logging.error(f"Error stopping servo: {e}")
 
+async def timing_demo():
+    # Run with the stand-in to check move timing on any machine: the forwards move is superseded after 0.2s
+    servo = Servo(PigpioStandIn())
+    start = time.monotonic()
+    servo.pwm.commands.clear()
+    forwards = servo.move_forwards()
+    await asyncio.sleep(0.2)
+    await asyncio.gather(forwards, servo.move_backwards())
+    servo.stop()
+    for timestamp, gpio, pulsewidth in servo.pwm.commands:
+        print(f"{timestamp - start:6.3f}s  gpio {gpio}  pulsewidth {pulsewidth}")
+
 if __name__ == "__main__":
-    servo = Servo()
-    servo.turn_forwards()
-    servo.turn_backwards()
-    servo.stop()
\ No newline at end of file
+    if pigpio is None:
+        asyncio.run(timing_demo())
+    else:
+        servo = Servo()
+        servo.turn_forwards()
+        servo.turn_backwards()
+        servo.stop()